@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class Rejected(Exception):
+    """
+    Raised when admission control turns a request away
+    """
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class LatencyRecorder:
+    """
+    Keeps the most recent latency samples for percentile stats
+    """
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+    
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+    
+    def stats(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': self.count}
+        
+        return {
+            'count': self.count,
+            'p50Ms': round(samples[len(samples) // 2] * 1000, 3),
+            'p99Ms': round(samples[int(len(samples) * 0.99)] * 1000, 3),
+            'maxMs': round(samples[-1] * 1000, 3)
+        }
+
+class AdmissionController:
+    """
+    Bounds how much of a burst reaches the database at once
+    
+    A token bucket limits the admission rate, a semaphore limits how many
+    admitted requests run concurrently and at most max_waiting callers may
+    queue for a slot; everything beyond that is rejected immediately with a
+    retry hint instead of piling up.
+    """
+    def __init__(self, max_concurrent=16, max_waiting=256, rate=200, burst=400, timeout=5):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+    
+    def _take_token(self):
+        # Must be called with the lock held
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+    
+    @contextmanager
+    def admit(self):
+        """
+        Run the body if admitted
+        
+        Raises:
+            Rejected: If the rate limit is hit, the queue is full or no slot
+                      frees up within the timeout
+        """
+        with self.lock:
+            if not self._take_token():
+                self.rejected += 1
+                raise Rejected('rate limited', (1 - self.tokens) / self.rate)
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise Rejected('queue full', self.timeout)
+            self.waiting += 1
+        
+        acquired = self.slots.acquire(timeout=self.timeout)
+        with self.lock:
+            self.waiting -= 1
+            if not acquired:
+                self.rejected += 1
+            else:
+                self.in_flight += 1
+                self.admitted += 1
+        if not acquired:
+            raise Rejected('timed out waiting', self.timeout)
+        
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+    
+    def stats(self):
+        return {
+            'inFlight': self.in_flight,
+            'queueDepth': self.waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected
+        }
@@ -4,8 +4,10 @@ from flask_cors import CORS
 import json
 import time
 import os
+import atexit
 from datetime import datetime
 import logging
+from pymongo.errors import PyMongoError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
@@ -13,24 +15,80 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 # Import our modules
-from database import get_db
-from models import User, Contact, Message
-from encryption import generate_key_pair, encrypt_message, decrypt_message
-from auth import require_auth, authenticate_user, get_current_user
+from database import close_client, get_database, get_db, init_db
+from cache import (get_user_summaries, invalidate_user, user_cache,
+                   session_user_cache, username_cache, is_contact, invalidate_contacts,
+                   contact_cache_stats)
+from keypool import key_pool_stats, close_key_pools
+from inbox import (page_size, get_contact_list, get_message_history, decode_cursor, mark_read,
+                   record_contact)
+from models import User, Contact, Message, is_id_list
+from encryption import (generate_key_pair, encrypt_message, decrypt_message,
+                        public_key_cache, private_key_cache)
+from auth import require_auth, authenticate_user, get_current_user, start_session
+from challenges import issue_challenge
+from presence import create_presence, user_room
+from admission import AdmissionController, LatencyRecorder, Rejected
+from delivery import acknowledge, get_pending
+from outbox import EmitBatcher
+from ingest import ingestor
 
 # Create Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
 app.config['JSON_SORT_KEYS'] = False
 
+# Set up database (pooled client, or in-memory when MONGO_URI is not set)
+init_db(app)
+atexit.register(close_client)
+atexit.register(close_key_pools)
+
 # Set up CORS
 CORS(app, supports_credentials=True, resources={r"/*": {"origins": "*"}})
 
-# Set up SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Set up SocketIO; with a message queue (e.g. redis://) emits reach sockets
+# held by any worker or host. wsgi.py sets SOCKETIO_ASYNC_MODE for production;
+# unset, Flask-SocketIO picks a mode itself.
+message_queue = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=message_queue,
+                    async_mode=os.getenv('SOCKETIO_ASYNC_MODE'))
+
+# Online users and their Socket.IO connections (one room per user)
+presence = create_presence(message_queue)
+atexit.register(presence.close)
+
+def presence_heartbeat():
+    """Keep this worker's connections from expiring in shared presence"""
+    while True:
+        socketio.sleep(presence.heartbeat_interval)
+        try:
+            presence.refresh()
+        except Exception as e:
+            logger.error(f"Error refreshing presence: {e}")
+
+if presence.heartbeat_interval:
+    socketio.start_background_task(presence_heartbeat)
+
+# Socket auth bursts (e.g. everyone reconnecting after a deploy) are served
+# from the session; admission control bounds the signature checks for the rest
+socket_auth_admission = AdmissionController(
+    max_concurrent=int(os.getenv('SOCKET_AUTH_CONCURRENCY', 16)),
+    max_waiting=int(os.getenv('SOCKET_AUTH_QUEUE', 256)),
+    rate=float(os.getenv('SOCKET_AUTH_RATE', 200)),
+    burst=int(os.getenv('SOCKET_AUTH_BURST', 400))
+)
+socket_auth_latency = LatencyRecorder()
+
+# Undelivered messages sent per sync_messages event
+SYNC_BATCH_SIZE = int(os.getenv('SYNC_BATCH_SIZE', 100))
 
-# User connections dict to track active users
-connected_users = {}
+# Outgoing message events, coalesced per receiver into batches
+outbox = EmitBatcher(
+    socketio,
+    window=int(os.getenv('EMIT_BATCH_WINDOW_MS', 10)) / 1000,
+    max_batch=int(os.getenv('EMIT_BATCH_SIZE', 100)),
+    max_unacked=int(os.getenv('EMIT_MAX_UNACKED', 1000))
+)
 
 @app.route('/')
 def index():
@@ -61,10 +119,10 @@ def create_user():
     # Save to database
     result = db.users.insert_one(new_user.to_dict())
     new_user._id = result.inserted_id
+    invalidate_user(new_user._id, new_user.username)
     
     # Store user in session
-    session['user_id'] = str(new_user._id)
-    session['username'] = new_user.username
+    start_session(new_user.to_dict())
     
     return jsonify({
         'id': str(new_user._id),
@@ -88,22 +146,32 @@ def get_user(user_id):
         'publicKey': user['public_key']
     })
 
+@app.route('/api/login/challenge', methods=['POST'])
+def login_challenge():
+    """Issue a single-use challenge for the user to sign"""
+    data = request.json
+    
+    if not data or not 'username' in data:
+        return jsonify({'error': 'Username is required'}), 400
+    
+    # Issued whether or not the user exists, so it does not reveal usernames
+    return jsonify(issue_challenge(data['username']))
+
 @app.route('/api/login', methods=['POST'])
 def login():
-    """Log in a user with username and private key proof"""
+    """Log in a user with username and a signature over their login challenge"""
     data = request.json
     
-    if not data or not 'username' in data or not 'privateKeyProof' in data:
-        return jsonify({'error': 'Username and private key proof are required'}), 400
+    if not data or not 'username' in data or not 'privateKeyProof' in data or not 'nonce' in data:
+        return jsonify({'error': 'Username, nonce and private key proof are required'}), 400
     
-    user = authenticate_user(data['username'], data['privateKeyProof'])
+    user = authenticate_user(data['username'], data['privateKeyProof'], data['nonce'])
     
     if not user:
         return jsonify({'error': 'Invalid username or private key'}), 401
     
     # Store user in session
-    session['user_id'] = str(user['_id'])
-    session['username'] = user['username']
+    start_session(user)
     
     return jsonify({
         'id': str(user['_id']),
@@ -125,29 +193,26 @@ def get_contacts():
     current_user = get_current_user()
     db = get_db()
     
-    # Get all contacts
-    contacts_list = []
-    contacts = db.contacts.find({'user_id': str(current_user['_id'])})
+    # Optional cursor pagination: ?limit=50&cursor=<nextCursor>
+    try:
+        limit = page_size(request.args.get('limit', type=int))
+    except ValueError:
+        return jsonify({'error': 'Limit must be at least 1'}), 400
+    cursor = request.args.get('cursor')
     
-    for contact in contacts:
-        # Get contact user details
-        contact_user = db.users.find_one({'_id': contact['contact_id']})
-        if not contact_user:
-            continue
-            
-        # Get last message between users (for preview)
-        last_message = db.messages.find_one({
-            '$or': [
-                {'sender_id': str(current_user['_id']), 'receiver_id': contact['contact_id']},
-                {'sender_id': contact['contact_id'], 'receiver_id': str(current_user['_id'])}
-            ]
-        }, sort=[('timestamp', -1)])
+    rows, next_cursor = get_contact_list(db, current_user['_id'], limit=limit, after=cursor)
+    
+    contacts_list = []
+    for row in rows:
+        contact_user = row['user']
+        last_message = row['last_message']
         
         # Format contact with last message
         contact_data = {
             'id': str(contact_user['_id']),
             'username': contact_user['username'],
             'publicKey': contact_user['public_key'],
+            'unreadCount': row['unread_count']
         }
         
         if last_message:
@@ -157,6 +222,9 @@ def get_contacts():
             
         contacts_list.append(contact_data)
     
+    if limit or cursor:
+        return jsonify({'contacts': contacts_list, 'nextCursor': next_cursor})
+    
     return jsonify(contacts_list)
 
 @app.route('/api/contacts', methods=['POST'])
@@ -197,6 +265,9 @@ def add_contact():
     
     db.contacts.insert_one(contact1.to_dict())
     db.contacts.insert_one(contact2.to_dict())
+    record_contact(db, current_user['_id'], contact_user['_id'])
+    invalidate_contacts(current_user['_id'])
+    invalidate_contacts(contact_user['_id'])
     
     return jsonify({
         'id': str(contact_user['_id']),
@@ -212,52 +283,76 @@ def get_messages(contact_id):
     current_user = get_current_user()
     db = get_db()
     
-    # Validate contact_id
-    contact = db.contacts.find_one({
-        'user_id': str(current_user['_id']), 
-        'contact_id': contact_id
-    })
-    
-    if not contact:
+    # Validate contact_id (cached contact set)
+    if not is_contact(db, current_user['_id'], contact_id):
         return jsonify({'error': 'Contact not found'}), 404
     
+    # Optional keyset pagination: ?limit=50&before=<nextCursor> or &after=<cursor>
+    try:
+        limit = page_size(request.args.get('limit', type=int))
+    except ValueError:
+        return jsonify({'error': 'Limit must be at least 1'}), 400
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if before and after:
+        return jsonify({'error': 'Pass either before or after, not both'}), 400
+    paginated = bool(limit or before or after)
+    
+    try:
+        messages, next_cursor = get_message_history(
+            db, current_user['_id'], contact_id, limit=limit, before=before, after=after
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
     # Get messages between users
     messages_list = []
-    messages = db.messages.find({
-        '$or': [
-            {'sender_id': str(current_user['_id']), 'receiver_id': contact_id},
-            {'sender_id': contact_id, 'receiver_id': str(current_user['_id'])}
-        ]
-    }).sort('timestamp', 1)
+    unread_ids = []
+    
+    # Sender usernames for the whole page (cached, at most one query)
+    senders = get_user_summaries(db, {message['sender_id'] for message in messages})
     
     for message in messages:
         # Get sender username
-        sender = db.users.find_one({'_id': message['sender_id']})
+        sender = senders.get(message['sender_id'])
         sender_username = sender['username'] if sender else 'Unknown'
         
-        # Format message
-        message_data = {
-            'id': str(message['_id']),
-            'senderId': message['sender_id'],
-            'senderUsername': sender_username, 
-            'receiverId': message['receiver_id'],
-            'content': message['content'],
-            'ipfsHash': message.get('ipfs_hash'),
-            'timestamp': message['timestamp'].isoformat(),
-            'encrypted': True
-        }
-        
-        messages_list.append(message_data)
+        messages_list.append(format_message(message, sender_username))
         
-        # Mark message as read if receiver is current user
+        # Collect unread messages addressed to the current user
         if message['receiver_id'] == str(current_user['_id']) and not message['is_read']:
-            db.messages.update_one(
-                {'_id': message['_id']},
-                {'$set': {'is_read': True}}
-            )
+            unread_ids.append(message['_id'])
+    
+    # Mark them read in one write: by id for a page, by watermark for the
+    # full history
+    if unread_ids:
+        if paginated:
+            receipts = mark_read(db, current_user['_id'], message_ids=unread_ids)
+        else:
+            receipts = mark_read(db, current_user['_id'], contact_id=contact_id,
+                                 up_to=messages[-1]['timestamp'])
+        # mark_read also clears them from the pending queue: fetched over
+        # REST counts as delivered
+        notify_read(current_user['_id'], receipts)
+    
+    if paginated:
+        return jsonify({'messages': messages_list, 'nextCursor': next_cursor})
     
     return jsonify(messages_list)
 
+def format_message(message, sender_username):
+    """Serialize a message document for the API and socket events"""
+    return {
+        'id': str(message['_id']),
+        'senderId': message['sender_id'],
+        'senderUsername': sender_username,
+        'receiverId': message['receiver_id'],
+        'content': message['content'],
+        'ipfsHash': message.get('ipfs_hash'),
+        'timestamp': message['timestamp'].isoformat(),
+        'encrypted': True
+    }
+
 @app.route('/api/messages', methods=['POST'])
 @require_auth
 def send_message():
@@ -269,13 +364,11 @@ def send_message():
     if not data or not 'receiverId' in data or not 'content' in data:
         return jsonify({'error': 'Receiver ID and content are required'}), 400
     
-    # Check if receiver is a contact
-    contact = db.contacts.find_one({
-        'user_id': str(current_user['_id']), 
-        'contact_id': data['receiverId']
-    })
+    if not isinstance(data['receiverId'], str) or not isinstance(data['content'], str):
+        return jsonify({'error': 'Receiver ID and content must be strings'}), 400
     
-    if not contact:
+    # Check if receiver is a contact (cached)
+    if not is_contact(db, current_user['_id'], data['receiverId']):
         return jsonify({'error': 'Receiver not found in contacts'}), 404
     
     # Create and save message
@@ -286,28 +379,16 @@ def send_message():
         ipfs_hash=data.get('ipfsHash')
     )
     
-    result = db.messages.insert_one(message.to_dict())
-    message._id = result.inserted_id
+    # Stored with concurrent sends in one batch; the receiver is notified by
+    # deliver_messages once the write is durable
+    message_doc = message.to_dict()
+    try:
+        ingestor.ingest(message_doc)
+    except PyMongoError:
+        return jsonify({'error': 'Message could not be stored'}), 503
     
     # Format response
-    message_data = {
-        'id': str(message._id),
-        'senderId': message.sender_id,
-        'senderUsername': current_user['username'],
-        'receiverId': message.receiver_id,
-        'content': message.content,
-        'ipfsHash': message.ipfs_hash,
-        'timestamp': message.timestamp.isoformat(),
-        'encrypted': True
-    }
-    
-    # Notify receiver through WebSocket if online
-    if data['receiverId'] in connected_users:
-        socketio.emit(
-            'new_message',
-            message_data,
-            room=connected_users[data['receiverId']]
-        )
+    message_data = format_message(message_doc, current_user['username'])
     
     return jsonify(message_data), 201
 
@@ -329,13 +410,81 @@ def mark_message_as_read(message_id):
         return jsonify({'error': 'Unauthorized'}), 403
     
     # Update message as read
-    db.messages.update_one(
-        {'_id': message_id},
-        {'$set': {'is_read': True}}
-    )
+    receipts = mark_read(db, current_user['_id'], message_ids=[message_id])
+    notify_read(current_user['_id'], receipts)
     
     return jsonify({'success': True})
 
+@app.route('/api/messages/read', methods=['PATCH'])
+@require_auth
+def mark_messages_as_read():
+    """Mark several messages as read, by ID or up to a cursor"""
+    data = request.json
+    current_user = get_current_user()
+    db = get_db()
+    
+    if not data or not ('messageIds' in data or 'contactId' in data):
+        return jsonify({'error': 'Message IDs or contact ID are required'}), 400
+    
+    if 'messageIds' in data:
+        if not is_id_list(data['messageIds']):
+            return jsonify({'error': 'Message IDs must be a list of strings'}), 400
+        receipts = mark_read(db, current_user['_id'], message_ids=data['messageIds'])
+    else:
+        # Mark everything from the contact read, optionally only up to a cursor
+        up_to = None
+        if data.get('upTo'):
+            try:
+                up_to, _ = decode_cursor(data['upTo'])
+            except ValueError:
+                return jsonify({'error': 'Invalid cursor'}), 400
+        receipts = mark_read(db, current_user['_id'], contact_id=data['contactId'], up_to=up_to)
+    
+    notify_read(current_user['_id'], receipts)
+    
+    return jsonify({
+        'success': True,
+        'updated': sum(receipt['count'] for receipt in receipts.values())
+    })
+
+def notify_read(reader_id, receipts):
+    """Send one coalesced read receipt to each sender who is online"""
+    for sender_id, receipt in receipts.items():
+        if sender_id not in presence:
+            continue
+        
+        socketio.emit(
+            'messages_read',
+            {
+                'readerId': str(reader_id),
+                'count': receipt['count'],
+                'readUntil': receipt['read_until'].isoformat() if receipt['read_until'] else None,
+                'messageIds': receipt['message_ids']
+            },
+            room=user_room(sender_id)
+        )
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Cache and queue statistics for this worker process"""
+    return jsonify({
+        'pid': os.getpid(),
+        'userCache': user_cache.stats(),
+        'sessionUserCache': session_user_cache.stats(),
+        'usernameCache': username_cache.stats(),
+        'contactCache': contact_cache_stats(),
+        'publicKeyCache': public_key_cache.stats(),
+        'privateKeyCache': private_key_cache.stats(),
+        'keyPools': key_pool_stats(),
+        'presence': presence.stats(),
+        'outbox': outbox.stats(),
+        'ingest': ingestor.stats(),
+        'socketAuth': {
+            'latency': socket_auth_latency.stats(),
+            'admission': socket_auth_admission.stats()
+        }
+    })
+
 # WebSocket Events
 @socketio.on('connect')
 def handle_connect():
@@ -347,43 +496,173 @@ def handle_disconnect():
     """Handle WebSocket disconnection"""
     logger.info(f"Client disconnected: {request.sid}")
     
-    # Remove user from connected_users
-    for user_id, sid in connected_users.items():
-        if sid == request.sid:
-            del connected_users[user_id]
-            logger.info(f"User {user_id} disconnected")
-            break
+    # Remove the connection from presence (O(1) via the sid -> user map)
+    user_id, last_connection = presence.disconnect(request.sid)
+    if last_connection:
+        outbox.reset(user_room(user_id))
+        logger.info(f"User {user_id} disconnected")
 
 @socketio.on('auth')
 def handle_auth(data):
     """Authenticate WebSocket connection"""
-    logger.info(f"Auth request: {data}")
+    start = time.perf_counter()
+    try:
+        user_id, username = resolve_socket_user(data or {})
+    except Rejected as e:
+        # Tell the client to back off rather than queueing without bound
+        emit('auth_error', {'error': e.reason, 'retryAfter': round(e.retry_after, 3)})
+        return
+    finally:
+        socket_auth_latency.record(time.perf_counter() - start)
     
-    username = data.get('username')
-    if not username:
+    if not user_id:
+        emit('auth_error', {'error': 'Authentication failed'})
         return
-        
+    
+    previous, _ = presence.connect(user_id, request.sid)
+    if previous is not None:
+        # Re-authenticated as someone else: stop receiving their events
+        leave_room(user_room(previous))
+    logger.debug(f"User {username} authenticated")
+    
+    # Join the user's room so every device gets direct messages; a new
+    # connection has nothing backed up in Socket.IO yet
+    join_room(user_room(user_id))
+    outbox.reset(user_room(user_id))
+    
+    # Start streaming whatever was missed while offline
+    send_pending(user_id)
+
+def resolve_socket_user(data):
+    """
+    Find the user for a socket auth event
+    
+    A logged-in HTTP session already identifies the user, so that needs no
+    database access. Otherwise the socket has to prove who it is like
+    /api/login does: a signature over a challenge from /api/login/challenge.
+    Those checks go through admission control.
+    
+    Returns:
+        tuple: (user ID, username), or (None, None) if not authenticated
+    """
+    username = data.get('username')
+    
+    user = session.get('user')
+    if user and (not username or username == user['username']):
+        return user['_id'], user['username']
+    
+    if not username or not data.get('nonce') or not data.get('privateKeyProof'):
+        return None, None
+    
+    with socket_auth_admission.admit():
+        user = authenticate_user(username, data['privateKeyProof'], data['nonce'])
+    
+    return (str(user['_id']), user['username']) if user else (None, None)
+
+def send_pending(user_id, cursor=None):
+    """
+    Emit one batch of the user's undelivered messages to this socket
+    
+    The client acks what it stored and asks for the next batch with
+    nextCursor, so a long backlog never floods the connection.
+    """
     db = get_db()
-    user = db.users.find_one({'username': username})
+    messages, next_cursor = get_pending(db, user_id, limit=SYNC_BATCH_SIZE, after=cursor)
+    senders = get_user_summaries(db, {message['sender_id'] for message in messages})
+    
+    emit('sync_messages', {
+        'messages': [
+            format_message(message, senders[message['sender_id']]['username']
+                           if message['sender_id'] in senders else 'Unknown')
+            for message in messages
+        ],
+        'nextCursor': next_cursor
+    })
     
-    if user:
-        user_id = str(user['_id'])
-        connected_users[user_id] = request.sid
-        logger.info(f"User {username} authenticated")
-        
-        # Join a room with the user's ID for direct messaging
-        join_room(request.sid)
+    # Caught up: live events resume if the room had fallen behind
+    if next_cursor is None:
+        outbox.reset(user_room(user_id))
+
+@socketio.on('sync')
+def handle_sync(data):
+    """Send the next batch of undelivered messages"""
+    user_id = presence.user_for(request.sid)
+    if not user_id:
+        return
+    
+    try:
+        send_pending(user_id, (data or {}).get('cursor'))
+    except ValueError:
+        emit('sync_error', {'error': 'Invalid cursor'})
+
+@socketio.on('ack')
+def handle_ack(data):
+    """Remove delivered messages from the user's pending queue"""
+    user_id = presence.user_for(request.sid)
+    if not user_id:
+        return
+    
+    message_ids = (data or {}).get('messageIds', [])
+    if not is_id_list(message_ids):
+        return
+    
+    acknowledge(get_db(), user_id, message_ids)
+    outbox.acknowledged(user_room(user_id), len(message_ids))
 
 @socketio.on('message')
 def handle_message(data):
-    """Handle incoming WebSocket message"""
-    # This can be used for real-time messaging
-    logger.info(f"Received message: {data}")
+    """
+    Store and deliver a message sent over the socket
+    
+    Goes through the same ingestion as POST /api/messages; the return value
+    is the Socket.IO acknowledgement for the sender.
+    """
+    sender_id = presence.user_for(request.sid)
+    if not sender_id:
+        return {'error': 'Authentication required'}
     
-    # Check if receiver is online and forward the message
+    data = data or {}
     receiver_id = data.get('receiverId')
-    if receiver_id and receiver_id in connected_users:
-        emit('new_message', data, room=connected_users[receiver_id])
+    if not receiver_id or not data.get('content'):
+        return {'error': 'Receiver ID and content are required'}
+    
+    if not isinstance(receiver_id, str) or not isinstance(data['content'], str):
+        return {'error': 'Receiver ID and content must be strings'}
+    
+    db = get_db()
+    if not is_contact(db, sender_id, receiver_id):
+        return {'error': 'Receiver not found in contacts'}
+    
+    message = Message(
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        content=data['content'],
+        ipfs_hash=data.get('ipfsHash')
+    )
+    
+    try:
+        ingestor.ingest(message.to_dict())
+    except PyMongoError:
+        return {'error': 'Message could not be stored'}
+    
+    return {'id': message.id, 'timestamp': message.timestamp.isoformat()}
+
+def deliver_messages(messages):
+    """Queue newly stored messages for receivers who are online"""
+    online = [message for message in messages if message['receiver_id'] in presence]
+    if not online:
+        return
+    
+    senders = get_user_summaries(get_database(), {message['sender_id'] for message in online})
+    for message in online:
+        sender = senders.get(message['sender_id'])
+        outbox.queue(
+            user_room(message['receiver_id']),
+            format_message(message, sender['username'] if sender else 'Unknown'),
+            track=presence.is_local(message['receiver_id'])
+        )
+
+ingestor.add_listener(deliver_messages)
 
 # Run the app
 if __name__ == '__main__':
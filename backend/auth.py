@@ -1,15 +1,69 @@
 from functools import wraps
 from flask import request, jsonify, session, g
 from database import get_db
+from cache import session_user_cache, username_cache
+from challenges import redeem_challenge
+from encryption import offload, verify_signature
+
+def start_session(user):
+    """
+    Log a user in on the (signed) session cookie
+    
+    The session carries the user's immutable fields, so later requests can
+    build the current user from the cookie alone.
+    """
+    session['user_id'] = str(user['_id'])
+    session['username'] = user['username']
+    session['user'] = {'_id': str(user['_id']), 'username': user['username']}
+
+def load_session_user(user_id):
+    """
+    Get a session user's document through the short-lived session_user_cache
+    """
+    user = session_user_cache.get(user_id)
+    if user is None:
+        db = get_db()
+        user = db.users.find_one({"_id": user_id})
+        if user is not None:
+            session_user_cache.set(user_id, user)
+    
+    return user
+
+def load_user_by_username(username):
+    """
+    Get a user's document by username through username_cache
+    
+    Unknown usernames are cached too, until a user with that name is created.
+    """
+    user = username_cache.get(username)
+    if user is None:
+        db = get_db()
+        user = db.users.find_one({"username": username}) or False
+        username_cache.set(username, user)
+    
+    return user or None
 
 def get_current_user():
     """
     Get the current authenticated user from session
+    
+    Resolved once per request and kept in g.current_user. Sessions created
+    by start_session need no database lookup at all; older sessions go
+    through session_user_cache.
     """
-    if 'user_id' in session:
-        db = get_db()
-        return db.users.find_one({"_id": session['user_id']})
-    return None
+    if 'current_user' in g:
+        return g.current_user
+    
+    if 'user_id' not in session:
+        return None
+    
+    user = session.get('user')
+    if not user or user.get('_id') != session['user_id']:
+        user = load_session_user(session['user_id'])
+    
+    if user is not None:
+        g.current_user = user
+    return user
 
 def require_auth(f):
     """
@@ -17,35 +71,37 @@ def require_auth(f):
     """
     @wraps(f)
     def decorated(*args, **kwargs):
-        # Check if user is authenticated
+        # Check if user is authenticated (also sets g.current_user)
         current_user = get_current_user()
         
         if not current_user:
             return jsonify({"message": "Authentication required"}), 401
         
-        # Add current user to g for the request
-        g.current_user = current_user
-        
         return f(*args, **kwargs)
     
     return decorated
 
-def authenticate_user(username, private_key_proof):
+def authenticate_user(username, private_key_proof, nonce=None):
     """
     Authenticate a user with username and private key proof
     
-    In a real implementation, this would verify a signature to prove
-    the user possesses the private key corresponding to their public key.
+    The proof is the user's signature (encryption.sign_message) over the
+    challenge issued for the nonce by challenges.issue_challenge. The nonce is
+    single-use and the public key is parsed once thanks to the key cache.
     
-    For this example, we're using a simplified approach.
+    Returns:
+        dict: The user document, or None if authentication failed
     """
-    db = get_db()
-    user = db.users.find_one({"username": username})
+    challenge = redeem_challenge(username, nonce)
+    if challenge is None:
+        return None
+    
+    user = load_user_by_username(username)
     
-    if not user:
+    if not user or not user.get('public_key'):
         return None
     
-    # In a real app, verify the private key proof against the stored public key
-    # For this example, we're skipping this step and assuming it's valid
+    if not offload(verify_signature, challenge, private_key_proof, user['public_key']):
+        return None
     
-    return user
\ No newline at end of file
+    return user
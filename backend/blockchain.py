@@ -1,51 +1,162 @@
 from web3 import Web3
-from eth_account.messages import encode_defunct
+from eth_account import Account
+from eth_account.messages import encode_defunct, defunct_hash_message
+from hexbytes import HexBytes
 import os
 import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from cache import TTLCache
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Web3 connection
-def get_web3():
+# Signing and signer recovery below are local and never touch a node; the
+# provider is for on-chain calls. One Web3 instance per provider URI, each with
+# its own pooled HTTP session, so calls reuse keep-alive connections instead of
+# opening a new session.
+_web3_instances = {}
+_web3_lock = threading.Lock()
+
+# Provider URI -> (connected, monotonic time of the check)
+_connection_state = {}
+
+def _create_session():
+    """
+    Create a requests session with a connection pool sized for the app
+    """
+    pool_size = int(os.environ.get('WEB3_POOL_SIZE', 20))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_web3(provider_uri=None):
     """
-    Get Web3 instance with provider from environment
+    Get the shared Web3 instance for a provider URI (from environment by default)
     """
-    provider_uri = os.environ.get('WEB3_PROVIDER_URI', 'https://mainnet.infura.io/v3/your-project-id')
+    provider_uri = provider_uri or os.environ.get('WEB3_PROVIDER_URI', 'https://mainnet.infura.io/v3/your-project-id')
     
     # For development/testing, we can use a mock provider
     if provider_uri == 'mock':
         return MockWeb3()
     
-    return Web3(Web3.HTTPProvider(provider_uri))
+    w3 = _web3_instances.get(provider_uri)
+    if w3 is None:
+        with _web3_lock:
+            w3 = _web3_instances.get(provider_uri)
+            if w3 is None:
+                provider = Web3.HTTPProvider(
+                    provider_uri,
+                    request_kwargs={'timeout': float(os.environ.get('WEB3_TIMEOUT', 10))},
+                    session=_create_session()
+                )
+                w3 = _web3_instances[provider_uri] = Web3(provider)
+    
+    return w3
+
+def is_connected(w3):
+    """
+    Check whether a Web3 provider is reachable, caching the answer
+    
+    The result is reused for WEB3_CONNECTED_TTL seconds (default 30) so that
+    calls do not pay an extra round-trip to the node before doing any work.
+    """
+    uri = getattr(getattr(w3, 'provider', None), 'endpoint_uri', None)
+    if uri is None:
+        return w3.is_connected()
+    
+    ttl = float(os.environ.get('WEB3_CONNECTED_TTL', 30))
+    state = _connection_state.get(uri)
+    now = time.monotonic()
+    if state is not None and now - state[1] < ttl:
+        return state[0]
+    
+    connected = w3.is_connected()
+    _connection_state[uri] = (connected, now)
+    return connected
 
 class MockWeb3:
     """
     Mock Web3 implementation for development without a real blockchain connection
     """
-    class MockAccount:
-        def sign_message(self, encoded_message):
-            class MockSignature:
-                def __init__(self):
-                    self.signature = b'mock_signature'
-            
-            return MockSignature()
-    
-    def __init__(self):
-        self.eth = type('eth', (), {
-            'account': type('account', (), {
-                'privateKeyToAccount': lambda pk: self.MockAccount()
-            }),
-            'accounts': type('accounts', (), {
-                'recover_message': lambda msg, signature: '0xMockAddress'
-            })
-        })
-    
-    @property
     def is_connected(self):
         return True
 
+# (message hash, signature) -> recovered address
+recovered_address_cache = TTLCache(
+    maxsize=int(os.environ.get('SIGNER_CACHE_SIZE', 4096)),
+    ttl=int(os.environ.get('SIGNER_CACHE_TTL', 3600))
+)
+
+def _signature_bytes(signature):
+    """
+    Normalize a signature given as hex (with or without 0x) or raw bytes
+    """
+    if isinstance(signature, str):
+        return bytes(HexBytes(signature))
+    return bytes(signature)
+
+def recover_address(message, signature):
+    """
+    Recover the address that signed a message, without touching the network
+    
+    Recovery is local secp256k1 math; results are cached by (message hash,
+    signature) since the same login challenge or message is often checked
+    more than once.
+    
+    Args:
+        message (str): The message that was signed (EIP-191 personal message)
+        signature (str): The signature, hex-encoded
+    
+    Returns:
+        str: Checksummed address
+    
+    Raises:
+        ValueError, ValidationError: If the signature is malformed
+    """
+    signature = _signature_bytes(signature)
+    key = (bytes(defunct_hash_message(text=message)), signature)
+    
+    address = recovered_address_cache.get(key)
+    if address is None:
+        address = Account.recover_message(encode_defunct(text=message), signature=signature)
+        recovered_address_cache.set(key, address)
+    
+    return address
+
+def recover_addresses(items):
+    """
+    Recover signers for many (message, signature) pairs
+    
+    Duplicate pairs are recovered once and cached pairs are not recovered at
+    all. Malformed signatures yield None rather than failing the batch.
+    
+    Args:
+        items: Iterable of (message, signature)
+    
+    Returns:
+        list: Checksummed address or None for each item, in input order
+    """
+    items = list(items)
+    recovered = {}
+    
+    for pair in items:
+        if pair in recovered:
+            continue
+        try:
+            recovered[pair] = recover_address(*pair)
+        except Exception as e:
+            print(f"Error recovering signer: {e}")
+            recovered[pair] = None
+    
+    return [recovered[pair] for pair in items]
+
 def verify_message(message, signature, address):
     """
     Verify a message was signed by the given address
@@ -58,19 +169,22 @@ def verify_message(message, signature, address):
     Returns:
         bool: True if signature is valid, False otherwise
     """
-    w3 = get_web3()
+    return verify_messages([(message, signature, address)])[0]
+
+def verify_messages(items):
+    """
+    Verify many (message, signature, address) triples in one call
     
-    if not w3.is_connected():
-        # Fall back to local verification if no blockchain connection
-        return True
+    Returns:
+        list: True or False for each item, in input order
+    """
+    items = list(items)
+    addresses = recover_addresses((message, signature) for message, signature, _ in items)
     
-    message_hash = encode_defunct(text=message)
-    try:
-        recovered_address = w3.eth.accounts.recover_message(message_hash, signature=signature)
-        return recovered_address.lower() == address.lower()
-    except Exception as e:
-        print(f"Error verifying message: {e}")
-        return False
+    return [
+        recovered is not None and recovered.lower() == address.lower()
+        for recovered, (_, _, address) in zip(addresses, items)
+    ]
 
 def sign_message(message, private_key):
     """
@@ -83,13 +197,7 @@ def sign_message(message, private_key):
     Returns:
         str: Signature
     """
-    w3 = get_web3()
-    
-    if not w3.is_connected():
-        # Return mock signature if no blockchain connection
-        return "0xMockSignature"
-    
     message_hash = encode_defunct(text=message)
-    signed_message = w3.eth.account.sign_message(message_hash, private_key=private_key)
+    signed_message = Account.sign_message(message_hash, private_key=private_key)
     
-    return signed_message.signature.hex()
\ No newline at end of file
+    return signed_message.signature.hex()
@@ -0,0 +1,254 @@
+import os
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, has_app_context
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after a fixed time
+    
+    Thread-safe (and gevent-safe once monkey-patched). Hits and misses are
+    counted so stats() can show how effective the cache is under load.
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            
+            self.misses += 1
+            return default
+    
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    
+    def pop(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            return entry[0] if entry else None
+    
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': round(self.hits / lookups, 4) if lookups else None
+        }
+
+# User ID -> immutable profile fields used when serializing messages
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('USER_CACHE_TTL', 300))
+)
+
+# User ID -> full user document for sessions that predate token-carried
+# fields; kept short so profile changes show up quickly
+session_user_cache = TTLCache(
+    maxsize=int(os.environ.get('SESSION_USER_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('SESSION_USER_CACHE_TTL', 30))
+)
+
+# Username -> user document (or False for an unknown username) for logins
+# and socket auth; user creation drops the entry
+username_cache = TTLCache(
+    maxsize=int(os.environ.get('USERNAME_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('USERNAME_CACHE_TTL', 300))
+)
+
+def get_user_summaries(db, user_ids):
+    """
+    Get username and public key for several users
+    
+    Looks in the per-request memo, then the process-wide user_cache, and
+    fetches whatever is left with one $in query.
+    
+    Returns:
+        dict: User ID -> {'_id', 'username', 'public_key'} (unknown IDs omitted)
+    """
+    memo = g.setdefault('user_summaries', {}) if has_app_context() else {}
+    
+    found = {}
+    missing = []
+    for user_id in {str(user_id) for user_id in user_ids}:
+        summary = memo.get(user_id) or user_cache.get(user_id)
+        if summary is not None:
+            found[user_id] = summary
+        else:
+            missing.append(user_id)
+    
+    if missing:
+        users = db.users.find({'_id': {'$in': missing}}, {'username': 1, 'public_key': 1})
+        for user in users:
+            summary = {
+                '_id': str(user['_id']),
+                'username': user['username'],
+                'public_key': user.get('public_key')
+            }
+            user_cache.set(summary['_id'], summary)
+            found[summary['_id']] = summary
+    
+    memo.update(found)
+    return found
+
+def get_user_summary(db, user_id):
+    """
+    Get username and public key for one user, or None if not found
+    """
+    return get_user_summaries(db, [user_id]).get(str(user_id))
+
+def invalidate_user(user_id, username=None):
+    """
+    Drop a user from the caches (call after creating or changing a user)
+    """
+    user_cache.pop(str(user_id))
+    session_user_cache.pop(str(user_id))
+    if username is not None:
+        username_cache.pop(username)
+    if has_app_context():
+        g.get('user_summaries', {}).pop(str(user_id), None)
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings (false positives, never false negatives)
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        # Standard sizing: m = -n ln p / (ln 2)^2 bits, k = m/n ln 2 hashes
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def _positions(self, item):
+        # Double hashing: position i is h1 + i * h2
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+    
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+    
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+# User ID -> (contact IDs, monotonic load time). Contact IDs are a frozenset,
+# or a BloomFilter for users with more than CONTACT_BLOOM_THRESHOLD contacts
+# (0 disables), which keeps huge lists small at the cost of confirming
+# positives through contact_pair_cache.
+contact_set_cache = TTLCache(
+    maxsize=int(os.environ.get('CONTACT_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('CONTACT_CACHE_TTL', 300))
+)
+
+# (user ID, contact ID) pairs confirmed as contacts, for Bloom-filtered users
+contact_pair_cache = TTLCache(
+    maxsize=int(os.environ.get('CONTACT_PAIR_CACHE_SIZE', 100000)),
+    ttl=int(os.environ.get('CONTACT_PAIR_CACHE_TTL', 3600))
+)
+
+CONTACT_BLOOM_THRESHOLD = int(os.environ.get('CONTACT_BLOOM_THRESHOLD', 0))
+
+# A negative answer from a cached set older than this many seconds is
+# re-checked by reloading the set, so contacts added through another worker
+# are seen quickly without every miss costing a query
+CONTACT_RECHECK_SECONDS = float(os.environ.get('CONTACT_RECHECK_SECONDS', 5))
+
+contact_check_stats = {'checks': 0, 'dbChecks': 0}
+
+def load_contact_set(db, user_id):
+    """
+    Load a user's contact IDs into contact_set_cache
+    
+    Returns:
+        frozenset or BloomFilter: The user's contact IDs
+    """
+    contact_ids = [contact['contact_id'] for contact in
+                   db.contacts.find({'user_id': user_id}, {'contact_id': 1, '_id': 0})]
+    contact_check_stats['dbChecks'] += 1
+    
+    if CONTACT_BLOOM_THRESHOLD and len(contact_ids) > CONTACT_BLOOM_THRESHOLD:
+        members = BloomFilter(len(contact_ids))
+        for contact_id in contact_ids:
+            members.add(contact_id)
+    else:
+        members = frozenset(contact_ids)
+    
+    contact_set_cache.set(user_id, (members, time.monotonic()))
+    return members
+
+def is_contact(db, user_id, contact_id):
+    """
+    Whether contact_id is in user_id's contacts, usually without a query
+    """
+    user_id, contact_id = str(user_id), str(contact_id)
+    contact_check_stats['checks'] += 1
+    
+    entry = contact_set_cache.get(user_id)
+    if entry is None:
+        members = load_contact_set(db, user_id)
+    else:
+        members, loaded = entry
+        if contact_id not in members and time.monotonic() - loaded > CONTACT_RECHECK_SECONDS:
+            members = load_contact_set(db, user_id)
+    
+    if contact_id not in members:
+        return False
+    if isinstance(members, frozenset):
+        return True
+    
+    # Bloom filter hit: confirm, since it can be a false positive
+    if contact_pair_cache.get((user_id, contact_id)):
+        return True
+    
+    contact_check_stats['dbChecks'] += 1
+    if db.contacts.find_one({'user_id': user_id, 'contact_id': contact_id}, {'_id': 1}) is None:
+        return False
+    
+    contact_pair_cache.set((user_id, contact_id), True)
+    return True
+
+def invalidate_contacts(user_id):
+    """
+    Drop a user's cached contact set (call after adding a contact)
+    """
+    contact_set_cache.pop(str(user_id))
+
+def contact_cache_stats():
+    checks = contact_check_stats['checks']
+    return {
+        'sets': contact_set_cache.stats(),
+        'pairs': contact_pair_cache.stats(),
+        'checks': checks,
+        'dbChecks': contact_check_stats['dbChecks'],
+        'servedFromCache': round(1 - contact_check_stats['dbChecks'] / checks, 4) if checks else None
+    }
@@ -0,0 +1,134 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Login challenges: the server issues a single-use nonce, the client signs the
+# challenge text with its private key and sends the signature back as
+# privateKeyProof. Nonces live in a store with a short TTL; the in-memory
+# store only works with a single worker, so set REDIS_URL to share it.
+
+CHALLENGE_TTL = int(os.environ.get('LOGIN_CHALLENGE_TTL', 120))
+
+class MemoryNonceStore:
+    """
+    Expiring nonce store for a single process
+    
+    Every nonce gets the same TTL, so insertion order is expiry order and
+    expired entries are evicted from the front on each write. The store is
+    also bounded so unauthenticated challenge requests cannot grow it forever.
+    """
+    def __init__(self, ttl=CHALLENGE_TTL, maxsize=100000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def _evict(self, now):
+        while self.data:
+            _, (_, expires) = next(iter(self.data.items()))
+            if expires > now and len(self.data) < self.maxsize:
+                break
+            self.data.popitem(last=False)
+    
+    def add(self, nonce, username):
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            self.data[nonce] = (username, now + self.ttl)
+    
+    def consume(self, nonce):
+        """
+        Remove a nonce and return the username it was issued to, or None if
+        it is unknown, expired or already used
+        """
+        with self.lock:
+            entry = self.data.pop(nonce, None)
+        
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+    
+    def __len__(self):
+        return len(self.data)
+
+class RedisNonceStore:
+    """
+    Expiring nonce store shared by every worker through Redis
+    """
+    def __init__(self, url, ttl=CHALLENGE_TTL, prefix='login-nonce:'):
+        import redis
+        
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.prefix = prefix
+    
+    def add(self, nonce, username):
+        self.client.set(self.prefix + nonce, username, ex=self.ttl)
+    
+    def consume(self, nonce):
+        # GETDEL is atomic, so a nonce can only be redeemed once
+        return self.client.getdel(self.prefix + nonce)
+    
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + '*'))
+
+_nonce_store = None
+_nonce_store_lock = threading.Lock()
+
+def get_nonce_store():
+    """
+    Get the process-wide nonce store (Redis when REDIS_URL is set)
+    """
+    global _nonce_store
+    
+    if _nonce_store is None:
+        with _nonce_store_lock:
+            if _nonce_store is None:
+                redis_url = os.environ.get('REDIS_URL')
+                if redis_url:
+                    _nonce_store = RedisNonceStore(redis_url)
+                else:
+                    _nonce_store = MemoryNonceStore(
+                        maxsize=int(os.environ.get('LOGIN_CHALLENGE_STORE_SIZE', 100000))
+                    )
+    
+    return _nonce_store
+
+def challenge_message(username, nonce):
+    """
+    The text a client signs to log in
+    """
+    return f"DecSecMsg login for {username}: {nonce}"
+
+def issue_challenge(username):
+    """
+    Issue a single-use login challenge for a username
+    
+    Returns:
+        dict: {'nonce', 'challenge', 'expiresIn'}
+    """
+    store = get_nonce_store()
+    nonce = secrets.token_urlsafe(32)
+    store.add(nonce, username)
+    
+    return {
+        'nonce': nonce,
+        'challenge': challenge_message(username, nonce),
+        'expiresIn': store.ttl
+    }
+
+def redeem_challenge(username, nonce):
+    """
+    Consume a nonce, returning the challenge text if it was issued to username
+    
+    A nonce is spent even when the username does not match, so a leaked or
+    guessed nonce cannot be retried.
+    """
+    if not nonce:
+        return None
+    
+    if get_nonce_store().consume(nonce) != username:
+        return None
+    return challenge_message(username, nonce)
@@ -20,6 +20,14 @@ class Config:
     # Web3 configuration
     WEB3_PROVIDER_URI = os.environ.get('WEB3_PROVIDER_URI', 'https://mainnet.infura.io/v3/your-project-id')
     
+    # Redis configuration (optional; shares login challenges and presence across workers)
+    REDIS_URL = os.environ.get('REDIS_URL')
+    PRESENCE_URL = os.environ.get('PRESENCE_URL')
+    
+    # Socket.IO message queue for fan-out across workers (redis://, amqp://, kafka://);
+    # queues other than redis:// also need PRESENCE_URL or REDIS_URL
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    
     # Session configuration
     SESSION_TYPE = 'filesystem'
     PERMANENT_SESSION_LIFETIME = 86400  # 24 hours in seconds
\ No newline at end of file
@@ -1,176 +1,399 @@
 import os
+import json
+import threading
+from datetime import datetime
+import click
 import pymongo
 from flask import g
-from datetime import datetime
 from pymongo import MongoClient
 from dotenv import load_dotenv
+from models import conversation_key
+from memory_db import MemoryDB
+from inbox import rebuild_conversations
 
 # Load environment variables
 load_dotenv()
 
+# One MongoClient per worker process. MongoClient is thread-safe and keeps its
+# own connection pool, so it is shared by every request handled in the process.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# Set by init_db when running without MongoDB
+_memory_db = None
+
+def get_client_options():
+    """
+    Build MongoClient pool and timeout options from the environment
+    """
+    return {
+        'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+        'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+        'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 60000)),
+        'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+        'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 10000)),
+    }
+
+def get_client():
+    """
+    Get the process-wide MongoClient, creating it on first use
+    
+    The client is created lazily rather than at import time so that gunicorn
+    can fork workers first; a client inherited across a fork is discarded and
+    the child builds its own. The lock is a plain threading.Lock, which gevent
+    monkey-patching turns into a cooperative lock.
+    """
+    global _client, _client_pid
+    
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            mongo_uri = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
+            _client = MongoClient(mongo_uri, connect=False, **get_client_options())
+            _client_pid = pid
+    
+    return _client
+
+def close_client():
+    """
+    Close the process-wide MongoClient (on shutdown)
+    """
+    global _client, _client_pid
+    
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+def _reset_client_after_fork():
+    """
+    Drop the parent's client in a forked child without closing its sockets
+    """
+    global _client, _client_pid, _client_lock
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_after_fork)
+
+def get_database():
+    """
+    Get the database handle for this process (no request context needed)
+    """
+    if _memory_db is not None:
+        return _memory_db
+    
+    # Use a specific database for this app
+    db_name = os.environ.get('MONGO_DB', 'decsecmsg')
+    return get_client()[db_name]
+
 def get_db():
     """
-    Get a database connection from Flask's g object or create a new one
+    Get the database handle for the current request
     """
     if 'db' not in g:
-        # In production, use environment variable for MongoDB connection
-        mongo_uri = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
-        client = MongoClient(mongo_uri)
-        
-        # Use a specific database for this app
-        db_name = os.environ.get('MONGO_DB', 'decsecmsg')
-        g.db = client[db_name]
-        
-        # Create indexes
-        create_indexes(g.db)
+        g.db = get_database()
     
     return g.db
 
 def close_db(e=None):
     """
-    Close the database connection at the end of a request
-    """
-    db = g.pop('db', None)
+    Release the database handle at the end of a request
     
-    if db is not None:
-        db.client.close()
+    The pooled client stays open; its connections are reused by later requests.
+    """
+    g.pop('db', None)
+
+# Declarative index manifest: collection name -> index specs. It is applied once
+# at startup by init_db (or with `flask init-indexes`) and never on the request
+# path. Names follow MongoDB's default "<field>_<direction>" naming so that
+# indexes created by older versions of the app are recognised.
+INDEXES = {
+    'users': [
+        {
+            'name': 'username_1',
+            'keys': [('username', pymongo.ASCENDING)],
+            'unique': True
+        }
+    ],
+    'contacts': [
+        {
+            'name': 'user_id_1_contact_id_1',
+            'keys': [('user_id', pymongo.ASCENDING), ('contact_id', pymongo.ASCENDING)],
+            'unique': True
+        }
+    ],
+    # Store-and-forward queue, paged per receiver in (timestamp, _id) order
+    'pending_deliveries': [
+        {
+            'name': 'user_id_1_timestamp_1__id_1',
+            'keys': [
+                ('user_id', pymongo.ASCENDING),
+                ('timestamp', pymongo.ASCENDING),
+                ('_id', pymongo.ASCENDING)
+            ]
+        }
+    ],
+    'messages': [
+        {
+            'name': 'timestamp_1',
+            'keys': [('timestamp', pymongo.ASCENDING)]
+        },
+        {
+            'name': 'sender_id_1_receiver_id_1_timestamp_1',
+            'keys': [
+                ('sender_id', pymongo.ASCENDING),
+                ('receiver_id', pymongo.ASCENDING),
+                ('timestamp', pymongo.ASCENDING)
+            ]
+        },
+        # Conversation history (keyset pages on timestamp, _id) for a user pair
+        {
+            'name': 'conversation_id_1_timestamp_-1__id_-1',
+            'keys': [
+                ('conversation_id', pymongo.ASCENDING),
+                ('timestamp', pymongo.DESCENDING),
+                ('_id', pymongo.DESCENDING)
+            ]
+        }
+    ]
+}
+
+# Indexes older versions created that nothing queries any more; create_indexes
+# drops them so MongoDB stops maintaining them on every write
+RETIRED_INDEXES = {
+    # Unread counts per sender, now kept in the conversation summaries
+    'messages': ['receiver_id_1_is_read_1_sender_id_1']
+}
 
 def create_indexes(db):
     """
-    Create necessary indexes for performance
+    Create every index declared in INDEXES and drop RETIRED_INDEXES
+    
+    create_index is a no-op for an index that already exists with the same
+    definition, so this is safe to run on every boot.
+    """
+    for collection_name, names in RETIRED_INDEXES.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        for name in names:
+            if name in existing:
+                collection.drop_index(name)
+    
+    for collection_name, specs in INDEXES.items():
+        collection = db[collection_name]
+        for spec in specs:
+            collection.create_index(
+                spec['keys'],
+                name=spec['name'],
+                unique=spec.get('unique', False)
+            )
+
+def check_indexes(db):
     """
-    # Username index for users collection
-    db.users.create_index([('username', pymongo.ASCENDING)], unique=True)
+    Compare the indexes in the database with INDEXES
     
-    # User-Contact index for contacts collection
-    db.contacts.create_index([
-        ('user_id', pymongo.ASCENDING),
-        ('contact_id', pymongo.ASCENDING)
-    ], unique=True)
+    Returns:
+        list: Drift entries as dicts with 'collection', 'index' and 'problem'
+              ('missing', 'extra' or 'mismatched')
+    """
+    drift = []
     
-    # Timestamp index for messages collection
-    db.messages.create_index([('timestamp', pymongo.ASCENDING)])
+    for collection_name, specs in INDEXES.items():
+        existing = db[collection_name].index_information()
+        expected = {spec['name']: spec for spec in specs}
+        
+        for name, spec in expected.items():
+            if name not in existing:
+                drift.append({'collection': collection_name, 'index': name, 'problem': 'missing'})
+                continue
+            
+            info = existing[name]
+            keys = [(field, int(direction)) for field, direction in info['key']]
+            if keys != list(spec['keys']) or bool(info.get('unique')) != spec.get('unique', False):
+                drift.append({'collection': collection_name, 'index': name, 'problem': 'mismatched'})
+        
+        for name in existing:
+            if name != '_id_' and name not in expected:
+                drift.append({'collection': collection_name, 'index': name, 'problem': 'extra'})
     
-    # Sender-Receiver index for messages collection
-    db.messages.create_index([
-        ('sender_id', pymongo.ASCENDING),
-        ('receiver_id', pymongo.ASCENDING),
-        ('timestamp', pymongo.ASCENDING)
-    ])
+    return drift
+
+def backfill_conversation_ids(db, batch_size=1000):
+    """
+    Set conversation_id on messages stored before the field existed
+    
+    Returns:
+        int: Number of messages updated
+    """
+    updated = 0
+    batch = []
+    
+    legacy = db.messages.find(
+        {'conversation_id': {'$exists': False}},
+        {'sender_id': 1, 'receiver_id': 1}
+    )
+    for message in legacy:
+        batch.append(pymongo.UpdateOne(
+            {'_id': message['_id']},
+            {'$set': {'conversation_id': conversation_key(message['sender_id'], message['receiver_id'])}}
+        ))
+        
+        if len(batch) >= batch_size:
+            updated += db.messages.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    
+    if batch:
+        updated += db.messages.bulk_write(batch, ordered=False).modified_count
+    
+    return updated
+
+def run_migration(db, name, migrate):
+    """
+    Run a one-off data migration in exactly one process
+    
+    The first process to insert the `migrations` document for `name` runs
+    it; every other worker or host sees the duplicate key and skips, so a
+    deploy does not start the same migration everywhere at once. A failed
+    run removes its document so a later boot retries.
+    
+    Returns:
+        The result of migrate(db), or None if another process claimed it
+    """
+    try:
+        db.migrations.insert_one({'_id': name, 'state': 'running', 'started_at': datetime.now()})
+    except pymongo.errors.DuplicateKeyError:
+        return None
+    
+    try:
+        result = migrate(db)
+    except Exception:
+        db.migrations.delete_one({'_id': name})
+        raise
+    
+    db.migrations.update_one(
+        {'_id': name},
+        {'$set': {'state': 'done', 'finished_at': datetime.now(), 'result': result}}
+    )
+    return result
+
+def explain_queries(db, user_id, contact_id):
+    """
+    Get the winning query plan for each hot query between two users
+    
+    Returns:
+        dict: Query name -> winning plan from explain()
+    """
+    key = conversation_key(user_id, contact_id)
+    cursors = {
+        'messages_history': db.messages.find({'conversation_id': key}).sort('timestamp', 1),
+        'messages_page': db.messages.find({'conversation_id': key}).sort(
+            [('timestamp', -1), ('_id', -1)]
+        ).limit(50),
+        'contacts_for_user': db.contacts.find({'user_id': user_id}),
+        'contact_pair': db.contacts.find({'user_id': user_id, 'contact_id': contact_id}).limit(1),
+        'user_by_username': db.users.find({'username': contact_id}).limit(1)
+    }
+    
+    return {
+        name: cursor.explain().get('queryPlanner', {}).get('winningPlan')
+        for name, cursor in cursors.items()
+    }
+
+def register_commands(app):
+    """
+    Register database maintenance commands with the Flask CLI
+    """
+    @app.cli.command('init-indexes')
+    def init_indexes_command():
+        """Create the indexes declared in INDEXES."""
+        create_indexes(get_database())
+        click.echo('Indexes created')
+    
+    @app.cli.command('check-indexes')
+    def check_indexes_command():
+        """Report missing, extra or mismatched indexes."""
+        drift = check_indexes(get_database())
+        for entry in drift:
+            click.echo(f"{entry['collection']}.{entry['index']}: {entry['problem']}")
+        if drift:
+            raise SystemExit(1)
+        click.echo('Indexes match the manifest')
+    
+    @app.cli.command('backfill-conversations')
+    def backfill_conversations_command():
+        """Add conversation_id to messages created before it existed."""
+        updated = backfill_conversation_ids(get_database())
+        click.echo(f'Updated {updated} messages')
+    
+    @app.cli.command('rebuild-conversations')
+    def rebuild_conversations_command():
+        """Recompute conversation summaries from the messages collection."""
+        written = rebuild_conversations(get_database())
+        click.echo(f'Rebuilt {written} conversations')
+    
+    @app.cli.command('explain-queries')
+    @click.argument('user_id')
+    @click.argument('contact_id')
+    def explain_queries_command(user_id, contact_id):
+        """Print the query plans used for two users' conversation."""
+        plans = explain_queries(get_database(), user_id, contact_id)
+        click.echo(json.dumps(plans, indent=2, default=str))
 
 def init_db(app):
     """
     Initialize the database connection and register close_db with the app
     """
+    global _memory_db
+    
     app.teardown_appcontext(close_db)
     
     # Create memory-only database for development if no MongoDB URI provided
     if not os.environ.get('MONGO_URI'):
         print("Using in-memory database for development")
-        # In-memory database using a simple dictionary
-        class MemoryCollection:
-            def __init__(self):
-                self.data = {}
-                self.counter = 1
-            
-            def find_one(self, query):
-                for _id, item in self.data.items():
-                    match = True
-                    for key, value in query.items():
-                        if key == '_id' and str(value) != str(_id):
-                            match = False
-                            break
-                        elif key != '_id' and item.get(key) != value:
-                            match = False
-                            break
-                    
-                    if match:
-                        return item.copy()
-                
-                return None
-            
-            def find(self, query=None):
-                results = []
-                
-                for _id, item in self.data.items():
-                    if not query:
-                        results.append(item.copy())
-                        continue
-                    
-                    match = True
-                    for key, value in query.items():
-                        if key == '$or':
-                            or_match = False
-                            for or_query in value:
-                                or_match_inner = True
-                                for or_key, or_value in or_query.items():
-                                    if item.get(or_key) != or_value:
-                                        or_match_inner = False
-                                        break
-                                
-                                if or_match_inner:
-                                    or_match = True
-                                    break
-                            
-                            if not or_match:
-                                match = False
-                                break
-                        elif item.get(key) != value:
-                            match = False
-                            break
-                    
-                    if match:
-                        results.append(item.copy())
-                
-                # In-memory sort (simple implementation for timestamp only)
-                class Sorter:
-                    def sort(self, field, direction=1):
-                        if isinstance(field, tuple) and field[0] == 'timestamp':
-                            reverse = direction == -1
-                            results.sort(key=lambda x: x.get('timestamp', datetime.min), reverse=reverse)
-                        return self
-                    
-                    def limit(self, n):
-                        return results[:n]
-                    
-                    def __iter__(self):
-                        return iter(results)
-                
-                return Sorter()
-            
-            def insert_one(self, document):
-                if '_id' not in document:
-                    document['_id'] = str(self.counter)
-                    self.counter += 1
-                
-                self.data[document['_id']] = document.copy()
-                
-                class Result:
-                    @property
-                    def inserted_id(self):
-                        return document['_id']
-                
-                return Result()
-            
-            def update_one(self, query, update):
-                item = self.find_one(query)
-                
-                if item:
-                    for key, value in update.get('$set', {}).items():
-                        item[key] = value
-                    
-                    self.data[item['_id']] = item
-            
-            def create_index(self, keys, **kwargs):
-                # No-op for in-memory database
-                pass
-        
-        class MemoryDB:
-            def __init__(self):
-                self.users = MemoryCollection()
-                self.contacts = MemoryCollection()
-                self.messages = MemoryCollection()
-                self.client = type('client', (), {'close': lambda: None})
-        
-        # Set up memory database
-        g.db = MemoryDB()
\ No newline at end of file
+        # Set up memory database, shared by every request in this process
+        _memory_db = MemoryDB()
+    
+    register_commands(app)
+    
+    # Apply the index manifest once at boot instead of on every request
+    if os.environ.get('MONGO_CREATE_INDEXES', '1') == '1':
+        try:
+            create_indexes(get_database())
+        except pymongo.errors.PyMongoError as e:
+            print(f"Could not create indexes at startup, run `flask init-indexes`: {e}")
+    
+    # Messages stored before conversation_id existed are invisible to history
+    # and read marking until they have one, so one process backfills them on
+    # the first boot (the update only adds the field, so traffic can go on)
+    try:
+        db = get_database()
+        if db.messages.find_one({'conversation_id': {'$exists': False}}, {'_id': 1}):
+            updated = run_migration(db, 'backfill-conversations', backfill_conversation_ids)
+            if updated is not None:
+                print(f"Added conversation_id to {updated} older messages")
+    except pymongo.errors.PyMongoError as e:
+        print(f"Could not backfill conversation ids, run `flask backfill-conversations`: {e}")
+    
+    # Likewise build the conversation summaries the contact list reads if this
+    # database has messages but none were ever recorded. Only one process
+    # does it, and it only inserts missing summaries so it never overwrites
+    # the counters workers already serving traffic keep up to date
+    try:
+        db = get_database()
+        if not db.conversations.find_one({}, {'_id': 1}) and db.messages.find_one({}, {'_id': 1}):
+            written = run_migration(
+                db, 'build-conversations',
+                lambda db: rebuild_conversations(db, missing_only=True)
+            )
+            if written is not None:
+                print(f"Built {written} conversation summaries")
+    except pymongo.errors.PyMongoError as e:
+        print(f"Could not build conversation summaries, run `flask rebuild-conversations`: {e}")
\ No newline at end of file
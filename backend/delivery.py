@@ -0,0 +1,101 @@
+from inbox import encode_cursor, decode_cursor
+
+# Store-and-forward delivery. Every stored message gets an entry in the
+# receiver's pending queue (`pending_deliveries`, one small document per
+# undelivered message) until a client acknowledges it:
+#
+#   _id          the message id
+#   user_id      the receiver
+#   timestamp    the message timestamp (queue order, with _id)
+#
+# A reconnecting client pages through its own queue only, so the cost of a
+# sync grows with the number of missed messages, not with the history.
+
+def enqueue(db, message):
+    """
+    Add a stored message to its receiver's pending queue
+    """
+    enqueue_many(db, [message])
+
+def enqueue_many(db, messages):
+    """
+    Add a batch of stored messages to their receivers' pending queues
+    """
+    if not messages:
+        return
+    
+    db.pending_deliveries.insert_many([
+        {
+            '_id': message['_id'],
+            'user_id': str(message['receiver_id']),
+            'timestamp': message['timestamp']
+        }
+        for message in messages
+    ], ordered=False)
+
+def acknowledge(db, user_id, message_ids):
+    """
+    Remove delivered messages from a user's pending queue
+    
+    Returns:
+        int: Number of queue entries removed
+    """
+    if not message_ids:
+        return 0
+    
+    result = db.pending_deliveries.delete_many({
+        '_id': {'$in': list(message_ids)},
+        'user_id': str(user_id)
+    })
+    return result.deleted_count
+
+def get_pending(db, user_id, limit=100, after=None):
+    """
+    Get a batch of a user's undelivered messages, oldest first
+    
+    Entries stay queued until acknowledged, so a client that drops mid-sync
+    gets them again next time.
+    
+    Args:
+        db: Database handle
+        user_id (str): The receiver
+        limit (int): Batch size
+        after (str): Cursor returned with the previous batch
+    
+    Returns:
+        tuple: (list of message documents, cursor for the next batch or None)
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    query = {'user_id': str(user_id)}
+    if after:
+        timestamp, message_id = decode_cursor(after)
+        query['timestamp'] = {'$gte': timestamp}
+        query['$or'] = [{'timestamp': {'$gt': timestamp}}, {'_id': {'$gt': message_id}}]
+    
+    entries = list(
+        db.pending_deliveries.find(query)
+        .sort([('timestamp', 1), ('_id', 1)])
+        .limit(limit + 1)
+    )
+    
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(entries[-1])
+    
+    if not entries:
+        return [], None
+    
+    messages = {
+        message['_id']: message
+        for message in db.messages.find({'_id': {'$in': [entry['_id'] for entry in entries]}})
+    }
+    
+    # Entries whose message no longer exists are dropped from the queue
+    missing = [entry['_id'] for entry in entries if entry['_id'] not in messages]
+    if missing:
+        acknowledge(db, user_id, missing)
+    
+    return [messages[entry['_id']] for entry in entries if entry['_id'] in messages], next_cursor
@@ -1,73 +1,457 @@
+import os
 import base64
+import hashlib
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Random import get_random_bytes
 from Crypto.Signature import pkcs1_15
 from Crypto.Hash import SHA256
+from cache import TTLCache
+from keypool import generate_pem_pair, get_key_pool
 
-def generate_key_pair():
+# Parsed keys with their reusable cipher and signature objects, keyed by a
+# fingerprint of the PEM. Importing a PEM (parsing plus key validation) costs
+# more than the RSA operation for public keys, so hot keys are parsed once.
+# Private keys get a smaller, short-lived cache of their own and can be
+# evicted explicitly with forget_private_key.
+public_key_cache = TTLCache(
+    maxsize=int(os.environ.get('PUBLIC_KEY_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('PUBLIC_KEY_CACHE_TTL', 3600))
+)
+private_key_cache = TTLCache(
+    maxsize=int(os.environ.get('PRIVATE_KEY_CACHE_SIZE', 64)),
+    ttl=int(os.environ.get('PRIVATE_KEY_CACHE_TTL', 300))
+)
+
+def key_fingerprint(key_pem):
+    """
+    SHA-256 fingerprint of a PEM-encoded key
+    """
+    if isinstance(key_pem, str):
+        key_pem = key_pem.encode('utf-8')
+    return hashlib.sha256(key_pem).hexdigest()
+
+def _load_key(key_pem, cache):
+    """
+    Get the parsed key, OAEP cipher and PKCS#1 v1.5 signature scheme for a PEM
+    """
+    fingerprint = key_fingerprint(key_pem)
+    
+    parsed = cache.get(fingerprint)
+    if parsed is None:
+        key = RSA.import_key(key_pem)
+        parsed = {
+            'key': key,
+            'cipher': PKCS1_OAEP.new(key),
+            'signer': pkcs1_15.new(key)
+        }
+        cache.set(fingerprint, parsed)
+    
+    return parsed
+
+def load_public_key(public_key_pem):
+    """
+    Get the cached parsed form of a public key
+    
+    Raises:
+        ValueError: If the PEM cannot be parsed
+    """
+    return _load_key(public_key_pem, public_key_cache)
+
+def load_private_key(private_key_pem):
+    """
+    Get the cached parsed form of a private key
+    
+    Raises:
+        ValueError: If the PEM cannot be parsed
+    """
+    return _load_key(private_key_pem, private_key_cache)
+
+def forget_private_key(private_key_pem):
+    """
+    Evict a private key from the cache (e.g. on logout or key rotation)
+    """
+    private_key_cache.pop(key_fingerprint(private_key_pem))
+
+def generate_key_pair(key_size=2048, timeout=None):
     """
     Generate a new RSA key pair
     
+    With KEY_POOL_ENABLED=1 the pair comes from the background key pool,
+    waiting up to `timeout` (default KEY_POOL_TIMEOUT seconds) and generating
+    synchronously if the pool stays empty.
+    
     Returns:
         tuple: (private_key, public_key) as PEM-encoded strings
+    
+    Raises:
+        ValueError: If key_size is below 1024 bits
+    """
+    if os.environ.get('KEY_POOL_ENABLED') == '1':
+        if timeout is None:
+            timeout = float(os.environ.get('KEY_POOL_TIMEOUT', 5))
+        try:
+            return get_key_pool(key_size).get(timeout=timeout)
+        except TimeoutError:
+            pass
+    
+    # Generate the RSA key pair and export both keys in PEM format
+    return generate_pem_pair(key_size)
+
+# Envelope format versions. Version 1 is the original raw RSA-OAEP ciphertext
+# (base64, at most ~190 bytes of plaintext with a 2048-bit key). Version 2 is a
+# hybrid envelope: the body is encrypted with a random AES-256-GCM data key and
+# only that key is RSA-wrapped, so payload size is unlimited and costs one RSA
+# operation. Version 2 strings carry a prefix that cannot occur in base64.
+ENVELOPE_V2 = 2
+ENVELOPE_V2_PREFIX = 'v2:'
+STREAM_MAGIC = b'DSMS'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _wrap_key(data_key, public_key_pem):
+    """
+    RSA-OAEP encrypt a symmetric data key for one recipient
     """
-    # Generate a 2048-bit RSA key pair
-    key = RSA.generate(2048)
+    return load_public_key(public_key_pem)['cipher'].encrypt(data_key)
+
+def _unwrap_key(wrapped_key, private_key_pem):
+    return load_private_key(private_key_pem)['cipher'].decrypt(wrapped_key)
+
+def encrypt_payload(data, public_key_pem):
+    """
+    Encrypt bytes of any size into a version 2 hybrid envelope
     
-    # Export private and public keys in PEM format
-    private_key = key.export_key().decode('utf-8')
-    public_key = key.publickey().export_key().decode('utf-8')
+    Layout: version (1 byte) | wrapped key length (2 bytes) | wrapped key |
+    nonce (12 bytes) | tag (16 bytes) | ciphertext. The version byte and the
+    wrapped key are authenticated as associated data.
+    
+    Args:
+        data (bytes): The payload
+        public_key_pem (str): Recipient's public key in PEM format
+    
+    Returns:
+        bytes: The envelope
+    """
+    data_key = get_random_bytes(32)
+    wrapped_key = _wrap_key(data_key, public_key_pem)
+    header = struct.pack('>BH', ENVELOPE_V2, len(wrapped_key)) + wrapped_key
     
-    return private_key, public_key
+    nonce = get_random_bytes(12)
+    cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    
+    return header + nonce + tag + ciphertext
+
+def decrypt_payload(envelope, private_key_pem):
+    """
+    Decrypt a version 2 hybrid envelope
+    
+    Args:
+        envelope (bytes): Output of encrypt_payload
+        private_key_pem (str): Recipient's private key in PEM format
+    
+    Returns:
+        bytes: The payload
+    
+    Raises:
+        ValueError: If the envelope is malformed or fails authentication
+    """
+    if len(envelope) < 3:
+        raise ValueError("Truncated envelope")
+    
+    version, key_length = struct.unpack_from('>BH', envelope)
+    if version != ENVELOPE_V2:
+        raise ValueError(f"Unsupported envelope version: {version}")
+    
+    offset = 3 + key_length
+    if len(envelope) < offset + 28:
+        raise ValueError("Truncated envelope")
+    
+    header = envelope[:offset]
+    nonce = envelope[offset:offset + 12]
+    tag = envelope[offset + 12:offset + 28]
+    ciphertext = envelope[offset + 28:]
+    
+    data_key = _unwrap_key(header[3:], private_key_pem)
+    
+    cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    return cipher.decrypt_and_verify(ciphertext, tag)
 
 def encrypt_message(message, public_key_pem):
     """
     Encrypt a message using the recipient's public key
     
     Args:
-        message (str): The message to encrypt
+        message (str): The message to encrypt (any length)
         public_key_pem (str): Recipient's public key in PEM format
     
     Returns:
-        str: Base64-encoded encrypted message
+        str: Version 2 envelope, "v2:" followed by base64
     """
-    # Import public key
-    recipient_key = RSA.import_key(public_key_pem)
-    
-    # Create cipher
-    cipher = PKCS1_OAEP.new(recipient_key)
+    envelope = encrypt_payload(message.encode('utf-8'), public_key_pem)
     
-    # Encrypt the message
-    encrypted_msg = cipher.encrypt(message.encode('utf-8'))
-    
-    # Return base64 encoded encrypted message
-    return base64.b64encode(encrypted_msg).decode('utf-8')
+    # Return base64 encoded envelope with its version prefix
+    return ENVELOPE_V2_PREFIX + base64.b64encode(envelope).decode('utf-8')
 
 def decrypt_message(encrypted_message, private_key_pem):
     """
     Decrypt a message using the recipient's private key
     
     Args:
-        encrypted_message (str): Base64-encoded encrypted message
+        encrypted_message (str): Version 2 envelope, or a version 1 base64
+                                 RSA-OAEP ciphertext from older messages
         private_key_pem (str): Recipient's private key in PEM format
     
     Returns:
         str: Decrypted message
     """
-    # Decode from base64
-    encrypted_bytes = base64.b64decode(encrypted_message)
+    if encrypted_message.startswith(ENVELOPE_V2_PREFIX):
+        envelope = base64.b64decode(encrypted_message[len(ENVELOPE_V2_PREFIX):])
+        return decrypt_payload(envelope, private_key_pem).decode('utf-8')
     
-    # Import private key
-    private_key = RSA.import_key(private_key_pem)
+    # Version 1: decode from base64
+    encrypted_bytes = base64.b64decode(encrypted_message)
     
-    # Create cipher
-    cipher = PKCS1_OAEP.new(private_key)
+    # Cached private key and cipher
+    cipher = load_private_key(private_key_pem)['cipher']
     
     # Decrypt the message
     decrypted_msg = cipher.decrypt(encrypted_bytes)
     
     return decrypted_msg.decode('utf-8')
 
+_crypto_executor = None
+_crypto_executor_lock = threading.Lock()
+
+def _gevent_patched():
+    """
+    True when gevent has monkey-patched threading (see wsgi.py)
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+def get_crypto_executor():
+    """
+    Get the process-wide thread pool used for batched RSA work
+    
+    pycryptodome releases the GIL inside its native code, so RSA operations on
+    several threads run in parallel. Sized by CRYPTO_THREADS (default: CPUs).
+    Under gevent the pool uses native threads rather than greenlets, so the
+    work really leaves the event loop.
+    """
+    global _crypto_executor
+    
+    with _crypto_executor_lock:
+        if _crypto_executor is None:
+            workers = int(os.environ.get('CRYPTO_THREADS', os.cpu_count() or 4))
+            if _gevent_patched():
+                from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+                _crypto_executor = NativeThreadPoolExecutor(max_workers=workers)
+            else:
+                _crypto_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crypto')
+    
+    return _crypto_executor
+
+def offload(fn, *args, **kwargs):
+    """
+    Run CPU-heavy crypto without blocking other connections
+    
+    Under gevent fn runs on the crypto executor and waiting for it yields to
+    other greenlets; with plain threads every request already has its own
+    thread, so fn simply runs in place.
+    """
+    if not _gevent_patched():
+        return fn(*args, **kwargs)
+    return get_crypto_executor().submit(fn, *args, **kwargs).result()
+
+def _reset_crypto_executor_after_fork():
+    global _crypto_executor, _crypto_executor_lock
+    _crypto_executor = None
+    _crypto_executor_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_crypto_executor_after_fork)
+
+def encrypt_for_recipients(message, public_key_pems):
+    """
+    Encrypt a message once for several recipients (group or multi-device)
+    
+    The body is encrypted a single time with a random AES-256-GCM data key and
+    only the 32-byte key is RSA-wrapped per recipient, so fan-out cost grows
+    with the number of recipients, not recipients x message size. Wrapping is
+    spread over the crypto thread pool when there are several recipients.
+    
+    Args:
+        message (str or bytes): The message to encrypt
+        public_key_pems (dict): Recipient ID -> public key in PEM format
+    
+    Returns:
+        dict: {'version', 'nonce', 'tag', 'ciphertext', 'keys'} with base64
+              values; 'keys' maps recipient ID -> wrapped data key
+    """
+    data = message.encode('utf-8') if isinstance(message, str) else message
+    
+    data_key = get_random_bytes(32)
+    nonce = get_random_bytes(12)
+    cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(bytes([ENVELOPE_V2]))
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    
+    recipients = list(public_key_pems.items())
+    if len(recipients) > 1:
+        wrapped = get_crypto_executor().map(lambda item: _wrap_key(data_key, item[1]), recipients)
+    else:
+        wrapped = [_wrap_key(data_key, pem) for _, pem in recipients]
+    
+    return {
+        'version': ENVELOPE_V2,
+        'nonce': base64.b64encode(nonce).decode('utf-8'),
+        'tag': base64.b64encode(tag).decode('utf-8'),
+        'ciphertext': base64.b64encode(ciphertext).decode('utf-8'),
+        'keys': {
+            recipient_id: base64.b64encode(key).decode('utf-8')
+            for (recipient_id, _), key in zip(recipients, wrapped)
+        }
+    }
+
+def decrypt_for_recipient(envelope, recipient_id, private_key_pem):
+    """
+    Decrypt a multi-recipient envelope with one recipient's private key
+    
+    Args:
+        envelope (dict): Output of encrypt_for_recipients
+        recipient_id (str): Which wrapped key to use
+        private_key_pem (str): That recipient's private key in PEM format
+    
+    Returns:
+        bytes: The message
+    
+    Raises:
+        KeyError: If the envelope has no key for the recipient
+        ValueError: If decryption or authentication fails
+    """
+    if envelope.get('version') != ENVELOPE_V2:
+        raise ValueError(f"Unsupported envelope version: {envelope.get('version')}")
+    
+    data_key = _unwrap_key(base64.b64decode(envelope['keys'][recipient_id]), private_key_pem)
+    
+    cipher = AES.new(data_key, AES.MODE_GCM, nonce=base64.b64decode(envelope['nonce']))
+    cipher.update(bytes([ENVELOPE_V2]))
+    return cipher.decrypt_and_verify(
+        base64.b64decode(envelope['ciphertext']),
+        base64.b64decode(envelope['tag'])
+    )
+
+def _chunk_nonce(prefix, index):
+    return prefix + struct.pack('>I', index)
+
+def encrypt_stream(source, destination, public_key_pem, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encrypt a large body (e.g. an attachment) from one file object to another
+    
+    The body is split into chunks, each sealed with AES-256-GCM under the same
+    data key with a counter nonce, so decryption can release authenticated
+    plaintext chunk by chunk. The last chunk is marked final in its associated
+    data, which makes truncation detectable.
+    
+    Layout: magic | wrapped key length (2 bytes) | wrapped key | nonce prefix
+    (8 bytes), then per chunk: final flag (1 byte) | length (4 bytes) |
+    ciphertext | tag (16 bytes). The flag is the chunk's associated data.
+    
+    Args:
+        source: Readable binary file object
+        destination: Writable binary file object
+        public_key_pem (str): Recipient's public key in PEM format
+        chunk_size (int): Plaintext bytes per chunk
+    
+    Returns:
+        int: Number of plaintext bytes encrypted
+    """
+    data_key = get_random_bytes(32)
+    wrapped_key = _wrap_key(data_key, public_key_pem)
+    nonce_prefix = get_random_bytes(8)
+    
+    destination.write(STREAM_MAGIC + struct.pack('>H', len(wrapped_key)) + wrapped_key + nonce_prefix)
+    
+    total = 0
+    index = 0
+    chunk = source.read(chunk_size)
+    while True:
+        next_chunk = source.read(chunk_size) if chunk else b''
+        final = not next_chunk
+        
+        flag = b'\x01' if final else b'\x00'
+        cipher = AES.new(data_key, AES.MODE_GCM, nonce=_chunk_nonce(nonce_prefix, index))
+        cipher.update(flag)
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        destination.write(flag + struct.pack('>I', len(ciphertext)) + ciphertext + tag)
+        
+        total += len(chunk)
+        index += 1
+        if final:
+            return total
+        chunk = next_chunk
+
+def decrypt_stream(source, destination, private_key_pem):
+    """
+    Decrypt the output of encrypt_stream from one file object to another
+    
+    Args:
+        source: Readable binary file object
+        destination: Writable binary file object
+        private_key_pem (str): Recipient's private key in PEM format
+    
+    Returns:
+        int: Number of plaintext bytes written
+    
+    Raises:
+        ValueError: If the stream is malformed, truncated or tampered with
+    """
+    def read_exact(n):
+        data = source.read(n)
+        if len(data) != n:
+            raise ValueError("Truncated encrypted stream")
+        return data
+    
+    if read_exact(len(STREAM_MAGIC)) != STREAM_MAGIC:
+        raise ValueError("Not an encrypted stream")
+    
+    key_length, = struct.unpack('>H', read_exact(2))
+    data_key = _unwrap_key(read_exact(key_length), private_key_pem)
+    nonce_prefix = read_exact(8)
+    
+    total = 0
+    index = 0
+    while True:
+        flag = read_exact(1)
+        length, = struct.unpack('>I', read_exact(4))
+        ciphertext = read_exact(length)
+        tag = read_exact(16)
+        
+        # The flag is authenticated, so a dropped tail or a forged final
+        # marker fails verification
+        cipher = AES.new(data_key, AES.MODE_GCM, nonce=_chunk_nonce(nonce_prefix, index))
+        cipher.update(flag)
+        chunk = cipher.decrypt_and_verify(ciphertext, tag)
+        final = flag == b'\x01'
+        
+        destination.write(chunk)
+        total += len(chunk)
+        index += 1
+        
+        if final:
+            if source.read(1):
+                raise ValueError("Data after the final chunk")
+            return total
+
 def sign_message(message, private_key_pem):
     """
     Sign a message using the sender's private key
@@ -79,14 +463,14 @@ def sign_message(message, private_key_pem):
     Returns:
         str: Base64-encoded signature
     """
-    # Import private key
-    private_key = RSA.import_key(private_key_pem)
+    # Cached private key and signature scheme
+    signer = load_private_key(private_key_pem)['signer']
     
     # Create a hash of the message
     h = SHA256.new(message.encode('utf-8'))
     
     # Sign the hash
-    signature = pkcs1_15.new(private_key).sign(h)
+    signature = signer.sign(h)
     
     # Return base64 encoded signature
     return base64.b64encode(signature).decode('utf-8')
@@ -107,15 +491,79 @@ def verify_signature(message, signature, public_key_pem):
         # Decode signature from base64
         signature_bytes = base64.b64decode(signature)
         
-        # Import public key
-        public_key = RSA.import_key(public_key_pem)
+        # Cached public key and signature scheme
+        verifier = load_public_key(public_key_pem)['signer']
         
         # Create a hash of the message
         h = SHA256.new(message.encode('utf-8'))
         
         # Verify the signature
-        pkcs1_15.new(public_key).verify(h, signature_bytes)
+        verifier.verify(h, signature_bytes)
         
         return True
-    except (ValueError, TypeError):
-        return False
\ No newline at end of file
+    except (ValueError, TypeError, IndexError):
+        return False
+
+def _verify_batch(public_key_pem, batch):
+    """
+    Verify a batch of signatures made with one key (runs in a worker process)
+    
+    Returns:
+        list: (item ID, bool) pairs
+    """
+    try:
+        # Parsed once per worker thanks to the key cache
+        verifier = load_public_key(public_key_pem)['signer']
+    except (ValueError, TypeError, IndexError):
+        return [(item_id, False) for item_id, _, _ in batch]
+    
+    results = []
+    for item_id, message, signature in batch:
+        try:
+            h = SHA256.new(message.encode('utf-8'))
+            verifier.verify(h, base64.b64decode(signature))
+            results.append((item_id, True))
+        except (ValueError, TypeError):
+            results.append((item_id, False))
+    
+    return results
+
+def verify_signatures(items, workers=None, batch_size=256):
+    """
+    Verify many signatures, e.g. when auditing history or ingesting messages
+    that were synced offline
+    
+    Items are grouped by public key so each key is imported once, split into
+    batches and verified across a process pool. Results are yielded as batches
+    finish, so their order differs from the input order.
+    
+    Args:
+        items: Iterable of (item ID, message, signature, public key PEM)
+        workers (int): Worker processes; 1 verifies in this process.
+                       Defaults to the number of CPUs.
+        batch_size (int): Signatures per task
+    
+    Yields:
+        tuple: (item ID, True if the signature is valid)
+    """
+    groups = {}
+    for item_id, message, signature, public_key_pem in items:
+        group = groups.setdefault(key_fingerprint(public_key_pem), (public_key_pem, []))
+        group[1].append((item_id, message, signature))
+    
+    tasks = [
+        (public_key_pem, batch[i:i + batch_size])
+        for public_key_pem, batch in groups.values()
+        for i in range(0, len(batch), batch_size)
+    ]
+    
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        for public_key_pem, batch in tasks:
+            yield from _verify_batch(public_key_pem, batch)
+        return
+    
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+        futures = [executor.submit(_verify_batch, public_key_pem, batch) for public_key_pem, batch in tasks]
+        for future in as_completed(futures):
+            yield from future.result()
@@ -0,0 +1,397 @@
+import base64
+from datetime import datetime
+from models import conversation_key
+
+# Conversation summaries live in the `conversations` collection, one document
+# per unordered user pair (_id is models.conversation_key):
+#
+#   participants           both user ids, sorted
+#   last_message_id        newest message in the conversation
+#   last_message_time
+#   last_message_content   (encrypted) content, for previews
+#   last_sender_id
+#   unread.<user_id>       messages addressed to that user not yet read
+#   last_read.<user_id>    timestamp of the newest message that user has read
+#
+# Each write below is a single-document update, so it is atomic on its own.
+
+# Largest page a client may ask for with ?limit=
+MAX_PAGE_SIZE = 200
+
+def page_size(limit):
+    """
+    Validate a requested page size, capping it at MAX_PAGE_SIZE
+    
+    Returns:
+        int: The page size, or None if no limit was requested
+    
+    Raises:
+        ValueError: If the limit is below 1
+    """
+    if limit is None:
+        return None
+    if limit < 1:
+        raise ValueError(f"Invalid page size: {limit}")
+    return min(limit, MAX_PAGE_SIZE)
+
+def get_contact_list(db, user_id, limit=None, after=None):
+    """
+    Get a user's contacts with profile, last message and unread count
+    
+    Runs three queries however many contacts the user has: the page of
+    contacts, an $in lookup for their profiles and an $in lookup for the
+    conversation summaries maintained by the record_* functions below.
+    
+    Args:
+        db: Database handle (MongoDB or in-memory)
+        user_id (str): Current user's ID
+        limit (int): Page size, or None for all contacts
+        after (str): Cursor returned with the previous page
+    
+    Returns:
+        tuple: (list of dicts with 'user', 'last_message' and 'unread_count',
+                cursor for the next page or None)
+    """
+    user_id = str(user_id)
+    
+    # Page through contacts in contact_id order (user_id_1_contact_id_1 index)
+    query = {'user_id': user_id}
+    if after:
+        query['contact_id'] = {'$gt': after}
+    
+    cursor = db.contacts.find(query, {'contact_id': 1}).sort('contact_id', 1)
+    if limit:
+        cursor = cursor.limit(limit + 1)
+    contact_ids = [contact['contact_id'] for contact in cursor]
+    
+    next_cursor = None
+    if limit and len(contact_ids) > limit:
+        contact_ids = contact_ids[:limit]
+        next_cursor = contact_ids[-1]
+    
+    if not contact_ids:
+        return [], None
+    
+    users = {
+        str(user['_id']): user
+        for user in db.users.find({'_id': {'$in': contact_ids}})
+    }
+    
+    # Conversation summaries, one _id lookup for the whole page
+    keys = {conversation_key(user_id, contact_id): contact_id for contact_id in contact_ids}
+    conversations = {
+        keys[conversation['_id']]: conversation
+        for conversation in db.conversations.find({'_id': {'$in': list(keys)}})
+    }
+    
+    rows = []
+    for contact_id in contact_ids:
+        user = users.get(contact_id)
+        if not user:
+            continue
+        
+        conversation = conversations.get(contact_id, {})
+        last_message = None
+        if conversation.get('last_message_id'):
+            last_message = {
+                'message_id': conversation['last_message_id'],
+                'content': conversation.get('last_message_content'),
+                'timestamp': conversation['last_message_time']
+            }
+        
+        rows.append({
+            'user': user,
+            'last_message': last_message,
+            'unread_count': conversation.get('unread', {}).get(user_id, 0)
+        })
+    
+    return rows, next_cursor
+
+def encode_cursor(message):
+    """
+    Encode a message's (timestamp, id) position as an opaque page cursor
+    """
+    position = f"{message['timestamp'].isoformat()}|{message['_id']}"
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    Decode a page cursor into (timestamp, message id)
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, message_id = position.split('|', 1)
+        return datetime.fromisoformat(timestamp), message_id
+    except ValueError as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def get_message_history(db, user_id, contact_id, limit=None, before=None, after=None):
+    """
+    Get a page of the conversation between two users, oldest first
+    
+    Pages are keyset ranges on (timestamp, _id) over the
+    conversation_id_1_timestamp_-1__id_-1 index, so fetching a page costs the
+    same however long the history is.
+    
+    Args:
+        db: Database handle
+        user_id (str): Current user's ID
+        contact_id (str): The other user's ID
+        limit (int): Page size, or None for the whole history
+        before (str): Cursor; return messages older than it (scrolling back)
+        after (str): Cursor; return messages newer than it (catching up)
+    
+    Returns:
+        tuple: (list of message documents, cursor for the next page or None)
+    
+    Raises:
+        ValueError: If a cursor is malformed or both cursors are given
+    """
+    if before and after:
+        raise ValueError("Pass either before or after, not both")
+    
+    query = {'conversation_id': conversation_key(user_id, contact_id)}
+    
+    # Without an `after` cursor pages run backwards from the newest message
+    direction = 1 if after else -1
+    cursor = before or after
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor)
+        op = '$gt' if after else '$lt'
+        query['timestamp'] = {op + 'e': timestamp}
+        query['$or'] = [{'timestamp': {op: timestamp}}, {'_id': {op: message_id}}]
+    
+    if not limit and not cursor:
+        return list(db.messages.find(query).sort('timestamp', 1)), None
+    
+    found = db.messages.find(query).sort([('timestamp', direction), ('_id', direction)])
+    if limit:
+        found = found.limit(limit + 1)
+    messages = list(found)
+    
+    next_cursor = None
+    if limit and len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_cursor(messages[-1])
+    
+    if direction == -1:
+        messages.reverse()
+    
+    return messages, next_cursor
+
+def record_contact(db, user_id, contact_id):
+    """
+    Create the conversation summary for a new contact pair if missing
+    """
+    participants = sorted([str(user_id), str(contact_id)])
+    db.conversations.update_one(
+        {'_id': conversation_key(user_id, contact_id)},
+        {'$setOnInsert': {'participants': participants, 'created_at': datetime.now()}},
+        upsert=True
+    )
+
+def record_message(db, message):
+    """
+    Update the conversation summary after a message was stored
+    
+    Args:
+        db: Database handle
+        message (dict): The stored message document
+    """
+    record_messages(db, [message])
+
+def record_messages(db, messages):
+    """
+    Update conversation summaries after a batch of messages was stored
+    
+    Messages are grouped by conversation so each summary is written once,
+    with the newest message and the summed unread increments.
+    """
+    by_conversation = {}
+    for message in messages:
+        key = conversation_key(message['sender_id'], message['receiver_id'])
+        by_conversation.setdefault(key, []).append(message)
+    
+    for key, group in by_conversation.items():
+        last = max(group, key=lambda message: (message['timestamp'], message['_id']))
+        unread = {}
+        for message in group:
+            field = f"unread.{message['receiver_id']}"
+            unread[field] = unread.get(field, 0) + 1
+        
+        db.conversations.update_one(
+            {'_id': key},
+            {
+                '$set': {
+                    'last_message_id': last['_id'],
+                    'last_message_time': last['timestamp'],
+                    'last_message_content': last.get('content'),
+                    'last_sender_id': str(last['sender_id'])
+                },
+                '$inc': unread,
+                '$setOnInsert': {
+                    'participants': sorted([str(last['sender_id']), str(last['receiver_id'])]),
+                    'created_at': datetime.now()
+                }
+            },
+            upsert=True
+        )
+
+def record_read(db, user_id, contact_id, read_count=None, read_until=None):
+    """
+    Update the conversation summary after a user read messages from a contact
+    
+    Args:
+        db: Database handle
+        user_id (str): User who read the messages
+        contact_id (str): The other side of the conversation
+        read_count (int): Number of messages newly marked read, or None if
+                          every message from the contact is now read
+        read_until (datetime): Timestamp of the newest message read
+    """
+    user_id = str(user_id)
+    update = {}
+    
+    if read_count is None:
+        update['$set'] = {f'unread.{user_id}': 0}
+    elif read_count:
+        update['$inc'] = {f'unread.{user_id}': -read_count}
+    
+    if read_until is not None:
+        update['$max'] = {f'last_read.{user_id}': read_until}
+    
+    if update:
+        db.conversations.update_one({'_id': conversation_key(user_id, contact_id)}, update)
+
+def mark_read(db, user_id, message_ids=None, contact_id=None, up_to=None):
+    """
+    Mark messages addressed to a user as read in bulk
+    
+    Either pass message_ids, or contact_id to mark that contact's messages read
+    up to (and including) the up_to timestamp, or all of them if up_to is None.
+    Issues one update_many per sender rather than one update per message.
+    Messages marked read also leave the reader's pending delivery queue.
+    
+    Args:
+        db: Database handle
+        user_id (str): The reader
+        message_ids (list): IDs of messages to mark read
+        contact_id (str): Sender whose messages to mark read
+        up_to (datetime): Read watermark for contact_id
+    
+    Returns:
+        dict: Sender ID -> {'count', 'read_until', 'message_ids'} for senders
+              with newly read messages ('message_ids' is None in watermark mode)
+    """
+    # delivery imports this module for its cursors
+    from delivery import acknowledge
+    
+    user_id = str(user_id)
+    receipts = {}
+    
+    if message_ids is not None:
+        # Read counts as delivered, including messages read before
+        message_ids = list(message_ids)
+        acknowledge(db, user_id, message_ids)
+        
+        unread = db.messages.find(
+            {'_id': {'$in': message_ids}, 'receiver_id': user_id, 'is_read': False},
+            {'sender_id': 1, 'timestamp': 1}
+        )
+        
+        by_sender = {}
+        for message in unread:
+            by_sender.setdefault(message['sender_id'], []).append(message)
+        
+        for sender_id, messages in by_sender.items():
+            ids = [message['_id'] for message in messages]
+            result = db.messages.update_many(
+                {'_id': {'$in': ids}, 'is_read': False},
+                {'$set': {'is_read': True}}
+            )
+            if not result.modified_count:
+                continue
+            
+            read_until = max(message['timestamp'] for message in messages)
+            record_read(db, user_id, sender_id, read_count=result.modified_count, read_until=read_until)
+            receipts[sender_id] = {
+                'count': result.modified_count,
+                'read_until': read_until,
+                'message_ids': ids
+            }
+        
+        return receipts
+    
+    query = {
+        'conversation_id': conversation_key(user_id, contact_id),
+        'receiver_id': user_id,
+        'is_read': False
+    }
+    if up_to is not None:
+        query['timestamp'] = {'$lte': up_to}
+    
+    read_ids = [message['_id'] for message in db.messages.find(query, {'_id': 1})]
+    result = db.messages.update_many(query, {'$set': {'is_read': True}})
+    acknowledge(db, user_id, read_ids)
+    if result.modified_count:
+        # Everything from the contact is read when there is no watermark
+        record_read(db, user_id, contact_id,
+                    read_count=result.modified_count if up_to is not None else None,
+                    read_until=up_to)
+        receipts[str(contact_id)] = {
+            'count': result.modified_count,
+            'read_until': up_to,
+            'message_ids': None
+        }
+    
+    return receipts
+
+def rebuild_conversations(db, missing_only=False):
+    """
+    Recompute every conversation summary from the messages collection
+    
+    Args:
+        db: Database handle
+        missing_only (bool): Only insert summaries that do not exist yet,
+                             leaving ones maintained by live traffic alone
+    
+    Returns:
+        int: Number of conversations written
+    """
+    summaries = {}
+    
+    for message in db.messages.find().sort('timestamp', 1):
+        sender_id = str(message['sender_id'])
+        receiver_id = str(message['receiver_id'])
+        key = conversation_key(sender_id, receiver_id)
+        
+        summary = summaries.setdefault(key, {
+            'participants': sorted([sender_id, receiver_id]),
+            'unread': {sender_id: 0, receiver_id: 0},
+            'last_read': {}
+        })
+        summary['last_message_id'] = message['_id']
+        summary['last_message_time'] = message['timestamp']
+        summary['last_message_content'] = message.get('content')
+        summary['last_sender_id'] = sender_id
+        
+        if message.get('is_read'):
+            summary['last_read'][receiver_id] = message['timestamp']
+        else:
+            summary['unread'][receiver_id] += 1
+    
+    written = 0
+    for key, summary in summaries.items():
+        if missing_only:
+            update = {'$setOnInsert': dict(summary, created_at=datetime.now())}
+        else:
+            update = {'$set': summary, '$setOnInsert': {'created_at': datetime.now()}}
+        
+        result = db.conversations.update_one({'_id': key}, update, upsert=True)
+        if not missing_only or result.upserted_id is not None:
+            written += 1
+    
+    return written
@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+from database import get_database
+from delivery import enqueue_many
+from inbox import record_messages
+
+# Message ingestion shared by REST send_message and the socket 'message'
+# event. Callers check the contact pair with cache.is_contact; ingest() then
+# stores the message together with whatever else arrived in the same few
+# milliseconds (one insert_many per batch), updates conversation summaries
+# and pending queues, and only then hands the stored messages to listeners
+# for delivery.
+
+def get_write_concern():
+    """
+    Write concern for message inserts from INGEST_WRITE_CONCERN (w) and
+    INGEST_JOURNAL (j); unset uses the client default
+    """
+    w = os.environ.get('INGEST_WRITE_CONCERN')
+    journal = os.environ.get('INGEST_JOURNAL')
+    if not w and not journal:
+        return None
+    
+    options = {}
+    if w:
+        options['w'] = int(w) if w.isdigit() else w
+    if journal:
+        options['j'] = journal == '1'
+    return WriteConcern(**options)
+
+class _Entry:
+    def __init__(self, message):
+        self.message = message
+        self.done = False
+        self.error = None
+
+class MessageIngestor:
+    """
+    Group commit for new messages
+    
+    Callers queue their message and one of them becomes the leader: it waits
+    `window` seconds for others to join, writes up to `max_batch` messages
+    with a single insert_many and wakes the callers whose messages were in
+    the batch. Nothing runs in the background, so this works the same with
+    threads or gevent.
+    """
+    def __init__(self, max_batch=100, window=0.002, write_concern=None):
+        self.max_batch = max_batch
+        self.window = window
+        self.write_concern = write_concern
+        self.queue = []
+        self.committing = False
+        self.condition = threading.Condition()
+        self.listeners = []
+        self.last_batch_size = 0
+        self.batches = 0
+        self.messages = 0
+        self.failures = 0
+        self.follow_up_errors = 0
+    
+    def add_listener(self, listener):
+        """
+        Call listener(messages) with each batch once it is stored
+        """
+        self.listeners.append(listener)
+    
+    def ingest(self, message):
+        """
+        Store a message document, returning once it is durably written
+        
+        Raises:
+            PyMongoError: If the write failed; anything else that stopped the
+                          batch (e.g. a document BSON cannot encode) is
+                          raised as is
+        """
+        entry = _Entry(message)
+        
+        with self.condition:
+            self.queue.append(entry)
+        
+        while True:
+            with self.condition:
+                while not entry.done and self.committing:
+                    self.condition.wait()
+                if entry.done:
+                    break
+                self.committing = True
+            
+            # Leader: while traffic is concurrent, give other senders a moment
+            # to join the batch; a lone sender is written straight away
+            if self.window and self.last_batch_size > 1 and len(self.queue) < self.max_batch:
+                time.sleep(self.window)
+            
+            with self.condition:
+                batch = self.queue[:self.max_batch]
+                del self.queue[:self.max_batch]
+            
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Nothing in the batch is known to be stored
+                for queued in batch:
+                    if queued.error is None:
+                        queued.error = e
+            finally:
+                with self.condition:
+                    for queued in batch:
+                        queued.done = True
+                    self.committing = False
+                    self.condition.notify_all()
+        
+        if entry.error is not None:
+            raise entry.error
+        return message
+    
+    def _commit(self, batch):
+        db = get_database()
+        messages = db.messages
+        if self.write_concern is not None:
+            messages = messages.with_options(write_concern=self.write_concern)
+        
+        docs = [entry.message for entry in batch]
+        try:
+            messages.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+            for index in failed:
+                batch[index].error = e
+        except Exception as e:
+            # A batch goes out as one insert command, so any other error (e.g.
+            # a document BSON cannot encode) means none of it was written
+            for entry in batch:
+                entry.error = e
+        
+        stored = [entry.message for entry in batch if entry.error is None]
+        self.last_batch_size = len(batch)
+        self.batches += 1
+        self.messages += len(stored)
+        self.failures += len(batch) - len(stored)
+        if not stored:
+            return
+        
+        # The messages are stored, so every caller in the batch gets success
+        # (a retry would duplicate them) and listeners still run; a missed
+        # summary is repaired by `flask rebuild-conversations`, a missed
+        # queue entry only means no redelivery after a disconnect
+        for follow_up in (record_messages, enqueue_many):
+            try:
+                follow_up(db, stored)
+            except Exception as e:
+                self.follow_up_errors += 1
+                print(f"Error in {follow_up.__name__} after storing messages: {e}")
+        
+        for listener in self.listeners:
+            try:
+                listener(stored)
+            except Exception as e:
+                # The messages are stored; delivery falls back to sync
+                print(f"Error delivering messages: {e}")
+    
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'failures': self.failures,
+            'followUpErrors': self.follow_up_errors,
+            'avgBatchSize': round(self.messages / self.batches, 2) if self.batches else None,
+            'queued': len(self.queue)
+        }
+
+ingestor = MessageIngestor(
+    max_batch=int(os.environ.get('INGEST_BATCH_SIZE', 100)),
+    window=int(os.environ.get('INGEST_BATCH_WINDOW_MS', 2)) / 1000,
+    write_concern=get_write_concern()
+)
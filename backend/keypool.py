@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from Crypto.PublicKey import RSA
+
+# RSA.generate refuses anything smaller
+MIN_KEY_SIZE = 1024
+
+def generate_pem_pair(key_size=2048):
+    """
+    Generate an RSA key pair (module-level so worker processes can run it)
+    
+    Returns:
+        tuple: (private_key, public_key) as PEM-encoded strings
+    """
+    key = RSA.generate(key_size)
+    
+    private_key = key.export_key().decode('utf-8')
+    public_key = key.publickey().export_key().decode('utf-8')
+    
+    return private_key, public_key
+
+class KeyPool:
+    """
+    Pool of pre-generated RSA key pairs kept at a target depth
+    
+    RSA.generate takes hundreds of milliseconds with a long tail, so worker
+    processes generate pairs ahead of time. get() hands one out in O(1) and
+    immediately schedules its replacement; when the pool is empty it blocks
+    up to a timeout.
+    
+    Failed generations are retried after a backoff that doubles with each
+    consecutive failure (up to `max_backoff` seconds); while backing off an
+    empty pool makes get() time out at once so callers can fall back.
+    """
+    def __init__(self, key_size=2048, target_depth=16, workers=None, backoff=0.5, max_backoff=60):
+        if key_size < MIN_KEY_SIZE:
+            raise ValueError(f"Key size must be at least {MIN_KEY_SIZE} bits")
+        
+        self.key_size = key_size
+        self.target_depth = target_depth
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.keys = deque()
+        self.in_flight = 0
+        self.handed_out = 0
+        self.waits = 0
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_error = None
+        self.retry_at = 0
+        self.executor = None
+        self.closed = False
+        self.condition = threading.Condition()
+    
+    def _refill(self):
+        """
+        Schedule generation until stored plus pending pairs reach the target
+        
+        Must be called with the condition held.
+        """
+        if self.closed or self._backing_off():
+            return
+        
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        
+        # A callback can run inline and start a backoff while this loops
+        while len(self.keys) + self.in_flight < self.target_depth and not self._backing_off():
+            self.in_flight += 1
+            future = self.executor.submit(generate_pem_pair, self.key_size)
+            future.add_done_callback(self._on_generated)
+    
+    def _backing_off(self):
+        return self.failures and time.monotonic() < self.retry_at
+    
+    def _on_generated(self, future):
+        with self.condition:
+            self.in_flight -= 1
+            if future.cancelled():
+                return
+            
+            error = future.exception()
+            if error is None:
+                self.keys.append(future.result())
+                self.failures = 0
+                self.condition.notify()
+            else:
+                if not self.failures:
+                    print(f"Key pool: {self.key_size}-bit generation failed: {error}")
+                self.failures += 1
+                self.last_error = repr(error)
+                delay = min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+                self.retry_at = time.monotonic() + delay
+                # Wake waiters so they stop waiting on a pool that is backing off
+                self.condition.notify_all()
+            self._refill()
+    
+    def start(self):
+        """
+        Start filling the pool (get() also starts it on first use)
+        """
+        with self.condition:
+            self._refill()
+        return self
+    
+    def get(self, timeout=None):
+        """
+        Take a key pair from the pool
+        
+        Args:
+            timeout (float): Seconds to wait when the pool is empty, or None
+                             to wait indefinitely
+        
+        Returns:
+            tuple: (private_key, public_key) as PEM-encoded strings
+        
+        Raises:
+            TimeoutError: If no key pair became available in time
+        """
+        with self.condition:
+            self._refill()
+            
+            if not self.keys:
+                self.waits += 1
+                ready = lambda: self.keys or (self._backing_off() and not self.in_flight)
+                if not self.condition.wait_for(ready, timeout=timeout) or not self.keys:
+                    raise TimeoutError(f"No {self.key_size}-bit key pair available")
+            
+            pair = self.keys.popleft()
+            self.handed_out += 1
+            self._refill()
+        
+        return pair
+    
+    def close(self):
+        with self.condition:
+            self.closed = True
+            executor, self.executor = self.executor, None
+        
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def stats(self):
+        return {
+            'keySize': self.key_size,
+            'depth': len(self.keys),
+            'targetDepth': self.target_depth,
+            'inFlight': self.in_flight,
+            'handedOut': self.handed_out,
+            'emptyWaits': self.waits,
+            'failures': self.failures,
+            'lastError': self.last_error
+        }
+
+# One pool per key size, per process
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_key_pool(key_size=2048):
+    """
+    Get (and start) the process-wide pool for a key size
+    
+    Depth and worker count come from KEY_POOL_DEPTH and KEY_POOL_WORKERS.
+    
+    Raises:
+        ValueError: If key_size is below MIN_KEY_SIZE
+    """
+    if key_size < MIN_KEY_SIZE:
+        raise ValueError(f"Key size must be at least {MIN_KEY_SIZE} bits")
+    
+    with _pools_lock:
+        pool = _pools.get(key_size)
+        if pool is None:
+            pool = KeyPool(
+                key_size=key_size,
+                target_depth=int(os.environ.get('KEY_POOL_DEPTH', 16)),
+                workers=int(os.environ.get('KEY_POOL_WORKERS', 0)) or None
+            ).start()
+            _pools[key_size] = pool
+    
+    return pool
+
+def close_key_pools():
+    """
+    Stop every pool started in this process and its worker processes
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    
+    for pool in pools:
+        pool.close()
+
+def key_pool_stats():
+    """
+    Stats for every pool started in this process
+    """
+    return {str(size): pool.stats() for size, pool in _pools.items()}
+
+def _reset_pools_after_fork():
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
@@ -0,0 +1,652 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from itertools import chain, product
+
+from pymongo.errors import DuplicateKeyError
+
+# In-memory storage engine used for development, CI and load tests when no
+# MONGO_URI is configured. It implements the subset of the pymongo Collection
+# API used by the app, with hash and ordered indexes declared through
+# create_index so lookups do not scan the whole collection.
+
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte'}
+
+def _sort_key(value):
+    """
+    Order values of different types the way MongoDB does (roughly)
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (7, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (8, value)
+    return (5, str(value))
+
+def _is_operator(value):
+    return isinstance(value, dict) and value and all(k.startswith('$') for k in value)
+
+# Marks a field that is absent from a document (as opposed to set to None)
+_MISSING = object()
+
+def _compare(doc_value, op, operand):
+    """
+    Evaluate a single query operator against a document value
+    """
+    if op == '$exists':
+        return (doc_value is not _MISSING) == bool(operand)
+    
+    # A missing field compares equal to null, as in MongoDB
+    value = None if doc_value is _MISSING else doc_value
+    if op == '$eq':
+        return value == operand
+    if op == '$ne':
+        return value != operand
+    if op == '$in':
+        return value in operand
+    if op == '$nin':
+        return value not in operand
+    
+    if doc_value is _MISSING or doc_value is None:
+        return False
+    try:
+        if op == '$gt':
+            return doc_value > operand
+        if op == '$gte':
+            return doc_value >= operand
+        if op == '$lt':
+            return doc_value < operand
+        if op == '$lte':
+            return doc_value <= operand
+    except TypeError:
+        # Values of different types never match a range
+        return False
+    
+    raise ValueError(f"Unsupported query operator: {op}")
+
+def get_path(doc, path, default=None):
+    """
+    Read a possibly dotted field path ('unread.<user_id>') from a document
+    """
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return default
+        value = value[part]
+    return value
+
+def _set_path(doc, path, value):
+    """
+    Set a dotted field path, copying nested dicts so stored documents are untouched
+    """
+    parts = path.split('.')
+    for part in parts[:-1]:
+        child = doc.get(part)
+        doc[part] = dict(child) if isinstance(child, dict) else {}
+        doc = doc[part]
+    doc[parts[-1]] = value
+
+def _unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        child = doc.get(part)
+        if not isinstance(child, dict):
+            return
+        doc[part] = dict(child)
+        doc = doc[part]
+    doc.pop(parts[-1], None)
+
+def matches(doc, query):
+    """
+    Check whether a document matches a MongoDB-style query
+    """
+    for key, value in query.items():
+        if key == '$or':
+            if not any(matches(doc, branch) for branch in value):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, branch) for branch in value):
+                return False
+        elif _is_operator(value):
+            doc_value = get_path(doc, key, _MISSING)
+            for op, operand in value.items():
+                if not _compare(doc_value, op, operand):
+                    return False
+        elif get_path(doc, key) != value:
+            return False
+    
+    return True
+
+def _normalize_keys(keys, direction=None):
+    """
+    Accept the key formats pymongo's create_index and sort accept
+    """
+    if isinstance(keys, str):
+        return [(keys, direction if direction is not None else 1)]
+    return [(field, d) for field, d in keys]
+
+class MemoryIndex:
+    """
+    Secondary index over one or more fields
+    
+    Every index keeps a hash map from the full key to document ids (equality
+    lookups and unique enforcement) and, per value of the leading fields, a
+    list sorted on the range field and then _id (range scans and ordered
+    reads, e.g. messages of one conversation by timestamp). The range field
+    is the last field, or the one before a trailing _id tie-breaker.
+    """
+    def __init__(self, name, keys, unique=False):
+        self.name = name
+        self.keys = keys
+        self.fields = [field for field, _ in keys]
+        self.unique = unique
+        self.exact = {}
+        self.ordered = {}
+        
+        if len(self.fields) > 1 and self.fields[-1] == '_id':
+            self.prefix_fields = self.fields[:-2]
+            self.range_field = self.fields[-2]
+        else:
+            self.prefix_fields = self.fields[:-1]
+            self.range_field = self.fields[-1]
+    
+    def key(self, doc):
+        return tuple(get_path(doc, field) for field in self.fields)
+    
+    def _entry(self, doc):
+        prefix = tuple(get_path(doc, field) for field in self.prefix_fields)
+        return prefix, (_sort_key(get_path(doc, self.range_field)), _sort_key(doc['_id']), doc['_id'])
+    
+    def conflicts(self, doc):
+        """
+        Get the id of another document that already holds this doc's unique key
+        """
+        if not self.unique:
+            return None
+        for _id in self.exact.get(self.key(doc), ()):
+            if _id != doc['_id']:
+                return _id
+        return None
+    
+    def add(self, doc):
+        self.exact.setdefault(self.key(doc), set()).add(doc['_id'])
+        
+        prefix, entry = self._entry(doc)
+        insort(self.ordered.setdefault(prefix, []), entry)
+    
+    def remove(self, doc):
+        key = self.key(doc)
+        
+        ids = self.exact.get(key)
+        if ids is not None:
+            ids.discard(doc['_id'])
+            if not ids:
+                del self.exact[key]
+        
+        prefix, entry = self._entry(doc)
+        entries = self.ordered.get(prefix)
+        if entries is not None:
+            i = bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+            if not entries:
+                del self.ordered[prefix]
+    
+    def scan(self, prefix, bounds, reverse=False):
+        """
+        Yield ids for one prefix, ordered by the range field and limited by bounds
+        """
+        entries = self.ordered.get(prefix, [])
+        lo, hi = 0, len(entries)
+        
+        for op, operand in bounds.items():
+            target = _sort_key(operand)
+            if op == '$gt':
+                lo = max(lo, bisect_right(entries, target, key=lambda entry: entry[0]))
+            elif op == '$gte':
+                lo = max(lo, bisect_left(entries, target, key=lambda entry: entry[0]))
+            elif op == '$lt':
+                hi = min(hi, bisect_left(entries, target, key=lambda entry: entry[0]))
+            elif op == '$lte':
+                hi = min(hi, bisect_right(entries, target, key=lambda entry: entry[0]))
+        
+        positions = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+        for i in positions:
+            yield entries[i][2]
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+class InsertManyResult:
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+class MemoryCursor:
+    """
+    Lazy query result supporting sort, skip, limit and explain
+    """
+    def __init__(self, collection, query=None, projection=None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+    
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_keys(key_or_list, direction)
+        return self
+    
+    def skip(self, n):
+        self._skip = n
+        return self
+    
+    def limit(self, n):
+        self._limit = n
+        return self
+    
+    def explain(self):
+        with self.collection.lock:
+            plan = self.collection._plan(self.query, self._sort)
+        return {'queryPlanner': {'winningPlan': plan['summary']}}
+    
+    def __iter__(self):
+        return iter(self._results())
+    
+    def _results(self):
+        collection = self.collection
+        
+        with collection.lock:
+            plan = collection._plan(self.query, self._sort)
+            ids = plan['ids']
+            
+            # The index already yields documents in the requested order
+            presorted = not self._sort or plan['order'] is not None
+            
+            docs = (collection.data[_id] for _id in ids if _id in collection.data)
+            docs = (doc for doc in docs if matches(doc, self.query))
+            
+            if not presorted:
+                docs = list(docs)
+                for field, direction in reversed(self._sort):
+                    docs.sort(key=lambda doc: _sort_key(get_path(doc, field)), reverse=direction == -1)
+            
+            results = []
+            skipped = 0
+            for doc in docs:
+                if skipped < self._skip:
+                    skipped += 1
+                    continue
+                results.append(collection._project(doc, self.projection))
+                if self._limit and len(results) >= self._limit:
+                    break
+        
+        return results
+
+class MemoryCollection:
+    """
+    In-memory collection with the pymongo methods used by the app
+    """
+    def __init__(self, name):
+        self.name = name
+        self.data = {}
+        self.counter = 1
+        self.indexes = {}
+        self.lock = threading.RLock()
+    
+    # Indexes
+    
+    def create_index(self, keys, name=None, unique=False, **kwargs):
+        keys = _normalize_keys(keys)
+        name = name or '_'.join(f'{field}_{direction}' for field, direction in keys)
+        
+        with self.lock:
+            if name in self.indexes:
+                return name
+            
+            index = MemoryIndex(name, keys, unique=unique)
+            for doc in self.data.values():
+                if index.conflicts(doc):
+                    raise DuplicateKeyError(f"E11000 duplicate key error index: {name}")
+                index.add(doc)
+            
+            self.indexes[name] = index
+        
+        return name
+    
+    def index_information(self):
+        info = {'_id_': {'key': [('_id', 1)]}}
+        for name, index in self.indexes.items():
+            info[name] = {'key': list(index.keys), 'unique': index.unique}
+        return info
+    
+    def drop_index(self, name):
+        with self.lock:
+            del self.indexes[name]
+    
+    def _check_unique(self, doc):
+        for index in self.indexes.values():
+            if index.conflicts(doc):
+                raise DuplicateKeyError(f"E11000 duplicate key error index: {index.name}")
+    
+    def _plan(self, query, sort=None):
+        """
+        Choose how to find candidate documents for a query
+        
+        Returns a dict with the candidate 'ids', the 'order' (1/-1) the ids
+        are sorted in for the requested sort, or None, and a 'summary' in
+        the shape of a MongoDB winning plan.
+        """
+        if '_id' in query and (not _is_operator(query['_id']) or set(query['_id']) == {'$in'}):
+            wanted = query['_id']['$in'] if _is_operator(query['_id']) else [query['_id']]
+            ids = []
+            for _id in wanted:
+                if _id not in self.data and str(_id) in self.data:
+                    _id = str(_id)
+                if _id in self.data:
+                    ids.append(_id)
+            return {'ids': list(dict.fromkeys(ids)), 'order': None, 'summary': {'stage': 'IDHACK'}}
+        
+        if set(query) == {'$or'}:
+            branches = [self._plan(branch) for branch in query['$or']]
+            if all(branch['summary']['stage'] != 'COLLSCAN' for branch in branches):
+                ids = list(dict.fromkeys(_id for branch in branches for _id in branch['ids']))
+                return {'ids': ids, 'order': None,
+                        'summary': {'stage': 'OR', 'inputStages': [b['summary'] for b in branches]}}
+        
+        equality = {}
+        bounds = {}
+        for field, value in query.items():
+            if field.startswith('$'):
+                continue
+            if not _is_operator(value):
+                equality[field] = [value]
+            elif set(value) == {'$eq'}:
+                equality[field] = [value['$eq']]
+            elif set(value) == {'$in'}:
+                equality[field] = list(value['$in'])
+            elif set(value) <= RANGE_OPERATORS:
+                bounds[field] = value
+        
+        best = None
+        for index in self.indexes.values():
+            fields = index.fields
+            last = index.range_field
+            
+            if all(field in equality for field in fields):
+                # Hash lookup on the full key (a union when $in is used)
+                keys = list(product(*(equality[field] for field in fields)))
+                candidate = {
+                    'score': len(fields) + 1,
+                    'ids': keys,
+                    'index': index,
+                    'kind': 'exact',
+                    'order': None
+                }
+            elif all(field in equality for field in index.prefix_fields):
+                # Ordered scan of one bucket, optionally bounded on the range field
+                prefixes = list(product(*(equality[field] for field in index.prefix_fields)))
+                order = None
+                if sort and len(prefixes) == 1 and sort[0][0] == last and (
+                        len(sort) == 1 or (len(sort) == 2 and sort[1] == ('_id', sort[0][1]))):
+                    order = sort[0][1]
+                candidate = {
+                    'score': len(index.prefix_fields) + (1 if last in bounds else 0) + (0.5 if order else 0),
+                    'ids': prefixes,
+                    'index': index,
+                    'kind': 'ordered',
+                    'order': order
+                }
+            else:
+                continue
+            
+            if candidate['score'] > 0 and (best is None or candidate['score'] > best['score']):
+                best = candidate
+        
+        if best is None:
+            return {'ids': list(self.data), 'order': None, 'summary': {'stage': 'COLLSCAN'}}
+        
+        index = best['index']
+        if best['kind'] == 'exact':
+            ids = []
+            for key in best['ids']:
+                ids.extend(index.exact.get(key, ()))
+            if len(best['ids']) > 1:
+                ids = list(dict.fromkeys(ids))
+        else:
+            # Lazy, so a sorted read with a limit stops after a few entries
+            ids = chain.from_iterable(
+                index.scan(prefix, bounds.get(index.range_field, {}), reverse=best['order'] == -1)
+                for prefix in best['ids']
+            )
+        
+        return {
+            'ids': ids,
+            'order': best['order'],
+            'summary': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': index.name}}
+        }
+    
+    def _project(self, doc, projection):
+        if not projection:
+            return doc.copy()
+        
+        projection = dict(projection)
+        include_id = projection.pop('_id', 1)
+        if any(projection.values()):
+            result = {field: doc[field] for field in projection if field in doc}
+        else:
+            result = {field: value for field, value in doc.items() if field not in projection}
+        
+        if include_id:
+            result['_id'] = doc['_id']
+        else:
+            result.pop('_id', None)
+        
+        return result
+    
+    # Reads
+    
+    def find(self, query=None, projection=None, sort=None, skip=0, limit=0):
+        cursor = MemoryCursor(self, query, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+    
+    def find_one(self, query=None, projection=None, sort=None):
+        for doc in self.find(query, projection, sort=sort, limit=1):
+            return doc
+        return None
+    
+    def count_documents(self, query):
+        with self.lock:
+            plan = self._plan(query)
+            return sum(1 for _id in plan['ids'] if _id in self.data and matches(self.data[_id], query))
+    
+    # Writes
+    
+    def _insert(self, document):
+        if '_id' not in document:
+            document['_id'] = str(self.counter)
+            self.counter += 1
+        
+        if document['_id'] in self.data:
+            raise DuplicateKeyError("E11000 duplicate key error index: _id_")
+        
+        doc = document.copy()
+        self._check_unique(doc)
+        
+        self.data[doc['_id']] = doc
+        for index in self.indexes.values():
+            index.add(doc)
+        
+        return doc['_id']
+    
+    def with_options(self, **kwargs):
+        # Write concern and read preference have no meaning in memory
+        return self
+    
+    def insert_one(self, document):
+        with self.lock:
+            return InsertOneResult(self._insert(document))
+    
+    def insert_many(self, documents, ordered=True):
+        with self.lock:
+            return InsertManyResult([self._insert(document) for document in documents])
+    
+    def _replace(self, old, new):
+        for index in self.indexes.values():
+            index.remove(old)
+        
+        try:
+            self._check_unique(new)
+        except DuplicateKeyError:
+            for index in self.indexes.values():
+                index.add(old)
+            raise
+        
+        self.data[new['_id']] = new
+        for index in self.indexes.values():
+            index.add(new)
+    
+    def _update(self, query, update, upsert, multi):
+        with self.lock:
+            plan = self._plan(query)
+            targets = [self.data[_id] for _id in plan['ids']
+                       if _id in self.data and matches(self.data[_id], query)]
+            if not multi:
+                targets = targets[:1]
+            
+            modified = 0
+            for old in targets:
+                new = apply_update(old, update)
+                if new != old:
+                    self._replace(old, new)
+                    modified += 1
+            
+            if targets or not upsert:
+                return UpdateResult(len(targets), modified)
+            
+            # Upsert: seed the new document from the query's equality fields
+            seed = {k: v for k, v in query.items() if not k.startswith('$') and not _is_operator(v)}
+            doc = apply_update(seed, update, inserting=True)
+            return UpdateResult(0, 0, upserted_id=self._insert(doc))
+    
+    def update_one(self, query, update, upsert=False):
+        return self._update(query, update, upsert, multi=False)
+    
+    def update_many(self, query, update, upsert=False):
+        return self._update(query, update, upsert, multi=True)
+    
+    def find_one_and_update(self, query, update, projection=None, sort=None, upsert=False,
+                            return_document=False):
+        with self.lock:
+            before = self.find_one(query, sort=sort)
+            if before is not None:
+                self.update_one({'_id': before['_id']}, update)
+            elif upsert:
+                self.update_one(query, update, upsert=True)
+            else:
+                return None
+            
+            if return_document:
+                # pymongo.ReturnDocument.AFTER
+                after = self.find_one({'_id': before['_id']}) if before else self.find_one(query)
+                return self._project(after, projection)
+            return self._project(before, projection) if before else None
+    
+    def delete_one(self, query):
+        return self._delete(query, multi=False)
+    
+    def delete_many(self, query):
+        return self._delete(query, multi=True)
+    
+    def _delete(self, query, multi):
+        with self.lock:
+            plan = self._plan(query)
+            targets = [_id for _id in plan['ids'] if _id in self.data and matches(self.data[_id], query)]
+            if not multi:
+                targets = targets[:1]
+            
+            for _id in targets:
+                doc = self.data.pop(_id)
+                for index in self.indexes.values():
+                    index.remove(doc)
+            
+            return DeleteResult(len(targets))
+
+def apply_update(doc, update, inserting=False):
+    """
+    Apply a MongoDB update document and return the updated copy
+    """
+    if not any(key.startswith('$') for key in update):
+        # Replacement document
+        return {**update, '_id': doc.get('_id')} if '_id' in doc else dict(update)
+    
+    new = doc.copy()
+    for op, fields in update.items():
+        for field, value in fields.items():
+            current = get_path(new, field, _MISSING)
+            
+            if op == '$set' or (op == '$setOnInsert' and inserting):
+                _set_path(new, field, value)
+            elif op == '$setOnInsert':
+                continue
+            elif op == '$unset':
+                _unset_path(new, field)
+            elif op == '$inc':
+                _set_path(new, field, (0 if current is _MISSING else current) + value)
+            elif op == '$max':
+                if current is _MISSING or _sort_key(value) > _sort_key(current):
+                    _set_path(new, field, value)
+            elif op == '$min':
+                if current is _MISSING or _sort_key(value) < _sort_key(current):
+                    _set_path(new, field, value)
+            elif op == '$push':
+                _set_path(new, field, (list(current) if current is not _MISSING else []) + [value])
+            elif op == '$addToSet':
+                items = list(current) if current is not _MISSING else []
+                if value not in items:
+                    _set_path(new, field, items + [value])
+            elif op == '$pull':
+                items = list(current) if current is not _MISSING else []
+                _set_path(new, field, [item for item in items if item != value])
+            else:
+                raise ValueError(f"Unsupported update operator: {op}")
+    
+    return new
+
+class MemoryDB:
+    """
+    In-memory database; collections are created on first access like pymongo's
+    """
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+        self.client = type('client', (), {'close': lambda: None})
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+    
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = MemoryCollection(name)
+            return self.collections[name]
@@ -1,6 +1,18 @@
 from datetime import datetime
 from bson.objectid import ObjectId
 
+def conversation_key(user_a, user_b):
+    """
+    Key identifying the conversation between two users, independent of order
+    """
+    return ':'.join(sorted([str(user_a), str(user_b)]))
+
+def is_id_list(value):
+    """
+    True if value is a list of ID strings, as clients send for bulk operations
+    """
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
 class User:
     def __init__(self, username, public_key, _id=None, created_at=None):
         self.id = _id if _id else str(ObjectId())
@@ -37,6 +49,7 @@ class Message:
         self.id = _id if _id else str(ObjectId())
         self.sender_id = sender_id
         self.receiver_id = receiver_id
+        self.conversation_id = conversation_key(sender_id, receiver_id)
         self.content = content
         self.ipfs_hash = ipfs_hash
         self.timestamp = timestamp if timestamp else datetime.now()
@@ -47,6 +60,7 @@ class Message:
             "_id": self.id,
             "sender_id": self.sender_id,
             "receiver_id": self.receiver_id,
+            "conversation_id": self.conversation_id,
             "content": self.content,
             "ipfs_hash": self.ipfs_hash,
             "timestamp": self.timestamp,
@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import deque
+
+class EmitBatcher:
+    """
+    Coalesces message events per room before they go out over Socket.IO
+    
+    Events queued for the same room within `window` seconds, or until
+    `max_batch` are waiting, leave as one packet: a single message is sent as
+    'new_message' as before, several as one 'new_messages' batch.
+    
+    Backpressure follows the client, not the server buffer: every message
+    pushed to a room counts as unacked until a client acks it (see
+    delivery.py). Once a room has `max_unacked` messages buffered or unacked
+    it is sent 'sync_required' and gets no more live events until it has
+    caught up through its pending queue, so a client that falls behind never
+    piles up events inside Socket.IO. Acks from any of a user's devices count
+    for the room, so with several devices the figure is approximate.
+    
+    Acks reach the worker holding the socket, so only rooms with a socket on
+    this worker are tracked. Events for other rooms (queued with
+    track=False) go out through the message queue without backpressure; the
+    worker holding the socket applies it to its own emits.
+    """
+    def __init__(self, socketio, window=0.01, max_batch=100, max_unacked=1000):
+        self.socketio = socketio
+        self.window = window
+        self.max_batch = max_batch
+        self.max_unacked = max_unacked
+        self.buffers = {}
+        self.unacked = {}
+        self.untracked = {}
+        self.lagging = set()
+        self.overflowed = set()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+        self.queued = 0
+        self.emits = 0
+        self.batched = 0
+        self.dropped = 0
+        self.max_batch_seen = 0
+        # [second, emits] for the last few seconds
+        self.emit_counts = deque(maxlen=11)
+    
+    def queue(self, room, event, track=True):
+        """
+        Queue a message event for a room
+        
+        Args:
+            room (str): The room
+            event (dict): The message event
+            track (bool): Count the event against the room's unacked limit;
+                          False for rooms whose sockets are on other workers
+        
+        Returns:
+            bool: False if the room is behind and the event was dropped
+        """
+        with self.lock:
+            if track and room in self.lagging:
+                self.dropped += 1
+                return False
+            
+            buffer = self.buffers.setdefault(room, [])
+            tracked = len(buffer) - self.untracked.get(room, 0)
+            accepted = not track or self.unacked.get(room, 0) + tracked < self.max_unacked
+            if accepted:
+                buffer.append(event)
+                self.queued += 1
+                if not track:
+                    self.untracked[room] = self.untracked.get(room, 0) + 1
+            else:
+                self.dropped += 1
+                self.lagging.add(room)
+                self.overflowed.add(room)
+            full = len(buffer) >= self.max_batch
+            
+            # The flusher runs only while something is buffered
+            if self.flusher is None:
+                self.flusher = self.socketio.start_background_task(self._run)
+        
+        if full:
+            self.flush(room)
+        return accepted
+    
+    def acknowledged(self, room, count):
+        """
+        Record that a client in the room stored `count` pushed messages
+        """
+        with self.lock:
+            remaining = self.unacked.get(room, 0) - count
+            if remaining > 0:
+                self.unacked[room] = remaining
+            else:
+                self.unacked.pop(room, None)
+    
+    def reset(self, room):
+        """
+        Forget a room's backlog: the client has caught up from its pending
+        queue or has gone away
+        """
+        with self.lock:
+            self.unacked.pop(room, None)
+            self.lagging.discard(room)
+    
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.window)
+            self.flush()
+            
+            with self.lock:
+                if not self.buffers and not self.overflowed:
+                    self.flusher = None
+                    return
+    
+    def _take(self, room):
+        # Must be called with the lock held
+        buffer = self.buffers.pop(room, [])
+        batches = [buffer[i:i + self.max_batch] for i in range(0, len(buffer), self.max_batch)]
+        overflowed = room in self.overflowed
+        self.overflowed.discard(room)
+        tracked = len(buffer) - self.untracked.pop(room, 0)
+        if tracked:
+            self.unacked[room] = self.unacked.get(room, 0) + tracked
+        return batches, overflowed
+    
+    def flush(self, room=None):
+        """
+        Send what is buffered for one room, or for every room
+        
+        Flushes are serialized so a room's events keep their order.
+        """
+        with self.flush_lock:
+            with self.lock:
+                rooms = [room] if room is not None else list(self.buffers)
+                pending = [(room, *self._take(room)) for room in rooms]
+            
+            for room, batches, overflowed in pending:
+                for batch in batches:
+                    if len(batch) == 1:
+                        self.socketio.emit('new_message', batch[0], room=room)
+                    else:
+                        self.socketio.emit('new_messages', {'messages': batch}, room=room)
+                    self._count(len(batch))
+                
+                if overflowed:
+                    self.socketio.emit('sync_required', {}, room=room)
+                    self._count(0)
+    
+    def _count(self, size):
+        second = int(time.monotonic())
+        with self.lock:
+            self.emits += 1
+            self.batched += size
+            self.max_batch_seen = max(self.max_batch_seen, size)
+            if self.emit_counts and self.emit_counts[-1][0] == second:
+                self.emit_counts[-1][1] += 1
+            else:
+                self.emit_counts.append([second, 1])
+    
+    def stats(self):
+        now = int(time.monotonic())
+        with self.lock:
+            recent = sum(count for second, count in self.emit_counts if now - second < 10)
+            return {
+                'queued': self.queued,
+                'emits': self.emits,
+                'emitsPerSec': round(recent / 10, 2),
+                'avgBatchSize': round(self.batched / self.emits, 2) if self.emits else None,
+                'maxBatchSize': self.max_batch_seen,
+                'dropped': self.dropped,
+                'bufferedRooms': len(self.buffers),
+                'laggingRooms': len(self.lagging),
+                'unacked': sum(self.unacked.values())
+            }
@@ -0,0 +1,220 @@
+import os
+import threading
+
+def user_room(user_id):
+    """
+    Socket.IO room holding every connection of one user
+    """
+    return f"user:{user_id}"
+
+class PresenceRegistry:
+    """
+    Which users are online and through which Socket.IO connections
+    
+    Keeps user ID -> set of sids and sid -> user ID so connect, disconnect
+    and lookups are all O(1), and a user may be connected from several
+    devices at once. Thread-safe (and gevent-safe once monkey-patched).
+    """
+    def __init__(self):
+        self.sids_by_user = {}
+        self.user_by_sid = {}
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.disconnects = 0
+        # Seconds between refresh() calls, None if shared state never expires
+        self.heartbeat_interval = None
+    
+    def connect(self, user_id, sid):
+        """
+        Register a connection for a user (re-authenticating a sid as another
+        user moves it)
+        
+        Returns:
+            tuple: (user ID the sid was moved away from or None,
+                    True if this is the user's first connection)
+        """
+        user_id = str(user_id)
+        with self.lock:
+            previous = self.user_by_sid.get(sid)
+            if previous == user_id:
+                return None, False
+            if previous is not None:
+                self._remove(previous, sid)
+            
+            self.user_by_sid[sid] = user_id
+            sids = self.sids_by_user.setdefault(user_id, set())
+            sids.add(sid)
+            self.connects += 1
+            return previous, len(sids) == 1
+    
+    def disconnect(self, sid):
+        """
+        Forget a connection
+        
+        Returns:
+            tuple: (user ID or None if the sid never authenticated,
+                    True if that was the user's last connection)
+        """
+        with self.lock:
+            user_id = self.user_by_sid.pop(sid, None)
+            if user_id is None:
+                return None, False
+            
+            self.disconnects += 1
+            return user_id, self._remove(user_id, sid)
+    
+    def _remove(self, user_id, sid):
+        # Must be called with the lock held
+        sids = self.sids_by_user.get(user_id)
+        if sids is None:
+            return False
+        
+        sids.discard(sid)
+        if sids:
+            return False
+        
+        del self.sids_by_user[user_id]
+        return True
+    
+    def is_online(self, user_id):
+        return str(user_id) in self.sids_by_user
+    
+    def is_local(self, user_id):
+        """
+        True if the user has a connection on this worker
+        """
+        return str(user_id) in self.sids_by_user
+    
+    def __contains__(self, user_id):
+        return self.is_online(user_id)
+    
+    def sids(self, user_id):
+        """
+        Copy of a user's connection sids (empty if offline)
+        """
+        with self.lock:
+            return set(self.sids_by_user.get(str(user_id), ()))
+    
+    def user_for(self, sid):
+        return self.user_by_sid.get(sid)
+    
+    def __len__(self):
+        return len(self.sids_by_user)
+    
+    def refresh(self):
+        """
+        Keep this worker's connections alive in shared state (nothing to do
+        for a local registry)
+        """
+    
+    def close(self):
+        """
+        Release shared state on shutdown (nothing to do for a local registry)
+        """
+    
+    def stats(self):
+        return {
+            'users': len(self.sids_by_user),
+            'connections': len(self.user_by_sid),
+            'connects': self.connects,
+            'disconnects': self.disconnects
+        }
+
+class RedisPresence(PresenceRegistry):
+    """
+    Presence shared by every worker through Redis
+    
+    Each user's sids are mirrored into a Redis set so any worker can tell
+    whether a user is connected somewhere; the local maps still answer for
+    this worker's own sockets without a round-trip. Pair it with
+    Flask-SocketIO's message_queue so emits to user rooms reach the worker
+    holding the socket. Sets expire after `ttl` seconds unless refresh() runs
+    (every heartbeat_interval), which bounds what a crashed worker leaves
+    behind without dropping long-lived sockets.
+    """
+    def __init__(self, url=None, client=None, prefix='presence:', ttl=300):
+        super().__init__()
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True)
+        
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.heartbeat_interval = ttl / 3
+    
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+    
+    def connect(self, user_id, sid):
+        previous, first = super().connect(user_id, sid)
+        
+        pipe = self.client.pipeline()
+        if previous is not None:
+            pipe.srem(self._key(previous), sid)
+        pipe.sadd(self._key(user_id), sid)
+        pipe.expire(self._key(user_id), self.ttl)
+        pipe.execute()
+        
+        return previous, first
+    
+    def disconnect(self, sid):
+        user_id, last_connection = super().disconnect(sid)
+        if user_id is not None:
+            self.client.srem(self._key(user_id), sid)
+        
+        return user_id, last_connection
+    
+    def is_online(self, user_id):
+        return super().is_online(user_id) or bool(self.client.exists(self._key(user_id)))
+    
+    def refresh(self):
+        """
+        Push back the expiry of every user connected to this worker
+        """
+        with self.lock:
+            connections = {user_id: list(sids) for user_id, sids in self.sids_by_user.items()}
+        
+        # Re-adding the sids also restores sets lost with a Redis restart
+        pipe = self.client.pipeline()
+        for user_id, sids in connections.items():
+            pipe.sadd(self._key(user_id), *sids)
+            pipe.expire(self._key(user_id), self.ttl)
+        pipe.execute()
+    
+    def close(self):
+        """
+        Remove this worker's connections from Redis (call on shutdown)
+        """
+        with self.lock:
+            entries = list(self.user_by_sid.items())
+        
+        pipe = self.client.pipeline()
+        for sid, user_id in entries:
+            pipe.srem(self._key(user_id), sid)
+        pipe.execute()
+
+def create_presence(message_queue=None):
+    """
+    Create the presence registry for this worker
+    
+    Uses Redis (PRESENCE_URL, else REDIS_URL, else a redis:// message queue)
+    so presence is shared across workers, or a process-local registry when
+    no Redis is configured.
+    
+    Raises:
+        ValueError: If a message queue is set but presence cannot be shared.
+                    Live delivery only emits to users this registry sees
+                    online, so a per-worker registry would silently skip
+                    users connected to other workers.
+    """
+    url = os.environ.get('PRESENCE_URL') or os.environ.get('REDIS_URL')
+    if not url and message_queue and message_queue.startswith(('redis://', 'rediss://')):
+        url = message_queue
+    
+    if url:
+        return RedisPresence(url, ttl=int(os.environ.get('PRESENCE_TTL', 300)))
+    
+    if message_queue:
+        raise ValueError("SOCKETIO_MESSAGE_QUEUE needs shared presence: set PRESENCE_URL or REDIS_URL")
+    return PresenceRegistry()
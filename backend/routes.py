@@ -1,7 +1,13 @@
 from flask import Blueprint, request, jsonify, session
+from pymongo.errors import PyMongoError
 from database import get_db
-from models import User, Contact, Message
-from auth import require_auth, get_current_user
+from cache import get_user_summaries, invalidate_contacts, invalidate_user
+from inbox import (page_size, get_contact_list, get_message_history, decode_cursor, mark_read,
+                   record_contact)
+from models import User, Contact, Message, is_id_list
+from ingest import ingestor
+from auth import require_auth, authenticate_user, get_current_user, start_session
+from challenges import issue_challenge
 from encryption import encrypt_message, decrypt_message
 
 # Create blueprint
@@ -28,6 +34,7 @@ def create_user():
     # Create new user
     user = User(username=username, public_key=public_key)
     user_id = db.users.insert_one(user.to_dict()).inserted_id
+    invalidate_user(user_id, username)
     
     # Get the created user (will have _id now)
     created_user = db.users.find_one({"_id": user_id})
@@ -52,26 +59,32 @@ def get_user(user_id):
     
     return jsonify(user)
 
+@api.route('/users/login/challenge', methods=['POST'])
+def login_challenge():
+    data = request.get_json()
+    
+    if not data or not data.get('username'):
+        return jsonify({"message": "Missing required fields"}), 400
+    
+    return jsonify(issue_challenge(data.get('username')))
+
 @api.route('/users/login', methods=['POST'])
 def login():
     data = request.get_json()
     
-    if not data or not data.get('username') or not data.get('privateKeyProof'):
+    if not data or not data.get('username') or not data.get('privateKeyProof') or not data.get('nonce'):
         return jsonify({"message": "Missing required fields"}), 400
     
     username = data.get('username')
     
-    db = get_db()
-    user = db.users.find_one({"username": username})
+    # Verify the signature over the challenge issued for this nonce
+    user = authenticate_user(username, data.get('privateKeyProof'), data.get('nonce'))
     
     if not user:
-        return jsonify({"message": "User not found"}), 404
-    
-    # In a real app, verify the private key proof
-    # For this example, we'll assume it's valid
+        return jsonify({"message": "Invalid username or private key proof"}), 401
     
     # Set user session
-    session['user_id'] = str(user['_id'])
+    start_session(user)
     
     # Return user data
     user_data = {
@@ -95,37 +108,40 @@ def get_contacts():
     if not user_id:
         return jsonify({"message": "User ID is required"}), 400
     
+    # Optional cursor pagination: ?limit=50&cursor=<nextCursor>
+    try:
+        limit = page_size(request.args.get('limit', type=int))
+    except ValueError:
+        return jsonify({"message": "Limit must be at least 1"}), 400
+    cursor = request.args.get('cursor')
+    
     db = get_db()
     contacts_data = []
     
-    # Find all contacts for this user
-    contacts = db.contacts.find({"user_id": user_id})
-    
-    for contact in contacts:
-        contact_user = db.users.find_one({"_id": contact.get('contact_id')})
-        if contact_user:
-            # Get last message
-            last_message = db.messages.find({
-                "$or": [
-                    {"sender_id": user_id, "receiver_id": contact.get('contact_id')},
-                    {"sender_id": contact.get('contact_id'), "receiver_id": user_id}
-                ]
-            }).sort("timestamp", -1).limit(1)
-            
-            last_message_data = None
-            last_message_time = None
-            
-            for msg in last_message:  # Will be at most one
-                last_message_data = msg.get('content')
-                last_message_time = msg.get('timestamp').isoformat() if hasattr(msg.get('timestamp', ''), 'isoformat') else msg.get('timestamp', '')
-            
-            contacts_data.append({
-                "id": str(contact_user.get('_id')),
-                "username": contact_user.get('username'),
-                "publicKey": contact_user.get('public_key'),
-                "lastMessage": last_message_data,
-                "lastMessageTime": last_message_time
-            })
+    rows, next_cursor = get_contact_list(db, user_id, limit=limit, after=cursor)
+    
+    for row in rows:
+        contact_user = row['user']
+        msg = row['last_message']
+        
+        last_message_data = None
+        last_message_time = None
+        
+        if msg:
+            last_message_data = msg.get('content')
+            last_message_time = msg.get('timestamp').isoformat() if hasattr(msg.get('timestamp', ''), 'isoformat') else msg.get('timestamp', '')
+        
+        contacts_data.append({
+            "id": str(contact_user.get('_id')),
+            "username": contact_user.get('username'),
+            "publicKey": contact_user.get('public_key'),
+            "lastMessage": last_message_data,
+            "lastMessageTime": last_message_time,
+            "unreadCount": row['unread_count']
+        })
+    
+    if limit or cursor:
+        return jsonify({"contacts": contacts_data, "nextCursor": next_cursor})
     
     # Sort by last message time, most recent first
     contacts_data.sort(key=lambda x: x.get('lastMessageTime') or "", reverse=True)
@@ -175,6 +191,10 @@ def add_contact():
     )
     db.contacts.insert_one(reverse_contact.to_dict())
     
+    record_contact(db, current_user_id, contact_id)
+    invalidate_contacts(current_user_id)
+    invalidate_contacts(contact_id)
+    
     return jsonify({
         "id": contact_id,
         "username": contact_user.get('username')
@@ -185,19 +205,32 @@ def add_contact():
 def get_messages(contact_id):
     user_id = request.args.get('userId', '1')  # Default to user 1 for testing
     
+    # Optional keyset pagination: ?limit=50&before=<nextCursor> or &after=<cursor>
+    try:
+        limit = page_size(request.args.get('limit', type=int))
+    except ValueError:
+        return jsonify({"message": "Limit must be at least 1"}), 400
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if before and after:
+        return jsonify({"message": "Pass either before or after, not both"}), 400
+    
     db = get_db()
     messages_data = []
     
-    # Find all messages between these two users
-    messages = db.messages.find({
-        "$or": [
-            {"sender_id": user_id, "receiver_id": contact_id},
-            {"sender_id": contact_id, "receiver_id": user_id}
-        ]
-    }).sort("timestamp", 1)
+    # Find messages between these two users
+    try:
+        messages, next_cursor = get_message_history(
+            db, user_id, contact_id, limit=limit, before=before, after=after
+        )
+    except ValueError:
+        return jsonify({"message": "Invalid cursor"}), 400
+    
+    # Sender usernames for the whole page (cached, at most one query)
+    senders = get_user_summaries(db, {message.get('sender_id') for message in messages})
     
     for message in messages:
-        sender = db.users.find_one({"_id": message.get('sender_id')})
+        sender = senders.get(message.get('sender_id'))
         sender_username = sender.get('username') if sender else 'Unknown'
         
         messages_data.append({
@@ -211,6 +244,9 @@ def get_messages(contact_id):
             "encrypted": True
         })
     
+    if limit or before or after:
+        return jsonify({"messages": messages_data, "nextCursor": next_cursor})
+    
     return jsonify(messages_data)
 
 @api.route('/messages', methods=['POST'])
@@ -220,6 +256,9 @@ def send_message():
     if not data or not data.get('receiverId') or not data.get('content'):
         return jsonify({"message": "Missing required fields"}), 400
     
+    if not isinstance(data['receiverId'], str) or not isinstance(data['content'], str):
+        return jsonify({"message": "Receiver ID and content must be strings"}), 400
+    
     sender_id = data.get('senderId', '1')  # Default to user 1 for testing
     receiver_id = data.get('receiverId')
     content = data.get('content')
@@ -235,14 +274,20 @@ def send_message():
         ipfs_hash=ipfs_hash
     )
     
-    message_id = db.messages.insert_one(message.to_dict()).inserted_id
+    # Store through the shared ingestion path (summaries, pending queue)
+    message_doc = message.to_dict()
+    try:
+        message_id = ingestor.ingest(message_doc)['_id']
+    except PyMongoError:
+        return jsonify({"message": "Message could not be stored"}), 503
     
-    # Get sender info
-    sender = db.users.find_one({"_id": sender_id})
+    # Get sender and receiver info (cached)
+    users = get_user_summaries(db, [sender_id, receiver_id])
+    
+    sender = users.get(sender_id)
     sender_username = sender.get('username') if sender else 'Unknown'
     
-    # Get receiver info
-    receiver = db.users.find_one({"_id": receiver_id})
+    receiver = users.get(receiver_id)
     receiver_username = receiver.get('username') if receiver else 'Unknown'
     
     # Prepare message data for response
@@ -265,9 +310,37 @@ def mark_message_as_read(message_id):
     db = get_db()
     
     # Update message as read
-    db.messages.update_one(
-        {"_id": message_id},
-        {"$set": {"is_read": True}}
-    )
+    message = db.messages.find_one({"_id": message_id})
+    if message:
+        mark_read(db, message.get('receiver_id'), message_ids=[message_id])
+    
+    return jsonify({"success": True})
+
+@api.route('/messages/read', methods=['PATCH'])
+def mark_messages_as_read():
+    data = request.get_json()
+    
+    if not data or not (data.get('messageIds') or data.get('contactId')):
+        return jsonify({"message": "Missing required fields"}), 400
+    
+    user_id = data.get('userId', '1')  # Default to user 1 for testing
     
-    return jsonify({"success": True})
\ No newline at end of file
+    db = get_db()
+    
+    if data.get('messageIds'):
+        if not is_id_list(data['messageIds']):
+            return jsonify({"message": "Message IDs must be a list of strings"}), 400
+        receipts = mark_read(db, user_id, message_ids=data.get('messageIds'))
+    else:
+        up_to = None
+        if data.get('upTo'):
+            try:
+                up_to, _ = decode_cursor(data.get('upTo'))
+            except ValueError:
+                return jsonify({"message": "Invalid cursor"}), 400
+        receipts = mark_read(db, user_id, contact_id=data.get('contactId'), up_to=up_to)
+    
+    return jsonify({
+        "success": True,
+        "updated": sum(receipt['count'] for receipt in receipts.values())
+    })
\ No newline at end of file
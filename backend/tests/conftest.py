@@ -0,0 +1,58 @@
+import os
+import sys
+from collections import Counter
+
+# The suite runs against the in-memory engine with plain threads
+os.environ.pop('MONGO_URI', None)
+os.environ['SOCKETIO_ASYNC_MODE'] = 'threading'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import cache
+import database
+from memory_db import MemoryCollection, MemoryDB
+
+@pytest.fixture
+def db(monkeypatch):
+    """
+    A fresh in-memory database with the index manifest applied, installed as
+    the process database, and empty process caches
+    """
+    memory = MemoryDB()
+    database.create_indexes(memory)
+    monkeypatch.setattr(database, '_memory_db', memory)
+    
+    for process_cache in (cache.user_cache, cache.session_user_cache, cache.username_cache,
+                          cache.contact_set_cache, cache.contact_pair_cache):
+        process_cache.clear()
+    
+    return memory
+
+@pytest.fixture
+def app(db, monkeypatch):
+    """
+    The Flask app, using the test database
+    """
+    from app import app
+    
+    # The first import installs the app's own in-memory database
+    monkeypatch.setattr(database, '_memory_db', db)
+    return app
+
+@pytest.fixture
+def query_counts(monkeypatch):
+    """
+    Counter of read queries per collection (find, find_one, count_documents)
+    """
+    counts = Counter()
+    
+    for name in ('find', 'find_one', 'count_documents'):
+        original = getattr(MemoryCollection, name)
+        
+        def counted(self, *args, _original=original, **kwargs):
+            counts[self.name] += 1
+            return _original(self, *args, **kwargs)
+        
+        monkeypatch.setattr(MemoryCollection, name, counted)
+    
+    return counts
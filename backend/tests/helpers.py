@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+from models import Contact, Message, User
+from inbox import record_contact, record_messages
+
+def make_user(db, username, public_key='key'):
+    user = User(username=username, public_key=public_key).to_dict()
+    db.users.insert_one(user)
+    return user
+
+def make_contacts(db, user, contact):
+    db.contacts.insert_one(Contact(user_id=user['_id'], contact_id=contact['_id']).to_dict())
+    db.contacts.insert_one(Contact(user_id=contact['_id'], contact_id=user['_id']).to_dict())
+    record_contact(db, user['_id'], contact['_id'])
+
+def make_messages(db, sender, receiver, count, start=None):
+    """
+    Store `count` messages one second apart and update the summaries
+    """
+    start = start or datetime(2024, 1, 1)
+    messages = [
+        Message(sender_id=sender['_id'], receiver_id=receiver['_id'], content=f"m{i}",
+                timestamp=start + timedelta(seconds=i)).to_dict()
+        for i in range(count)
+    ]
+    db.messages.insert_many(messages)
+    record_messages(db, messages)
+    return messages
@@ -0,0 +1,78 @@
+import pytest
+from tests.helpers import make_contacts, make_messages, make_user
+
+def login(app, user):
+    """
+    A test client whose session is logged in as user
+    """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user['_id']
+        session['username'] = user['username']
+        session['user'] = {'_id': user['_id'], 'username': user['username']}
+    return client
+
+@pytest.fixture
+def alice_and_bob(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_contacts(db, alice, bob)
+    return alice, bob
+
+@pytest.mark.parametrize('limit', ['0', '-1', '-5'])
+def test_contacts_reject_bad_limits(app, alice_and_bob, limit):
+    alice, _ = alice_and_bob
+    
+    response = login(app, alice).get(f'/api/contacts?limit={limit}')
+    
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('limit', ['0', '-5'])
+def test_messages_reject_bad_limits(app, alice_and_bob, limit):
+    alice, bob = alice_and_bob
+    
+    response = login(app, alice).get(f"/api/messages/{bob['_id']}?limit={limit}")
+    
+    assert response.status_code == 400
+
+def test_messages_cap_the_page_size(app, db, alice_and_bob):
+    alice, bob = alice_and_bob
+    make_messages(db, bob, alice, 205)
+    
+    response = login(app, alice).get(f"/api/messages/{bob['_id']}?limit=1000")
+    
+    assert response.status_code == 200
+    assert len(response.get_json()['messages']) == 200
+
+def test_messages_reject_before_and_after_together(app, alice_and_bob):
+    alice, bob = alice_and_bob
+    
+    response = login(app, alice).get(f"/api/messages/{bob['_id']}?before=x&after=y")
+    
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('message_ids', [[{'a': 1}], [1, 2], ['ok', None], 'abc'])
+def test_mark_read_rejects_malformed_message_ids(app, alice_and_bob, message_ids):
+    alice, bob = alice_and_bob
+    
+    response = login(app, alice).patch('/api/messages/read', json={'messageIds': message_ids})
+    
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('payload', [
+    {'content': {'$gt': ''}},
+    {'content': ['a']},
+    {'content': 10 ** 30},
+])
+def test_send_message_rejects_non_string_fields(app, alice_and_bob, payload):
+    alice, bob = alice_and_bob
+    
+    response = login(app, alice).post('/api/messages', json=dict({'receiverId': bob['_id']}, **payload))
+    
+    assert response.status_code == 400
+
+def test_send_message_rejects_a_non_string_receiver(app, alice_and_bob):
+    alice, bob = alice_and_bob
+    
+    response = login(app, alice).post('/api/messages', json={'receiverId': [bob['_id']], 'content': 'hi'})
+    
+    assert response.status_code == 400
@@ -0,0 +1,52 @@
+import pytest
+
+from auth import authenticate_user
+from challenges import issue_challenge
+from encryption import generate_key_pair, sign_message
+from tests.helpers import make_user
+
+@pytest.fixture(scope='module')
+def key_pair():
+    return generate_key_pair()
+
+@pytest.fixture
+def context(app):
+    with app.app_context():
+        yield
+
+def prove(username, private_key):
+    challenge = issue_challenge(username)
+    return sign_message(challenge['challenge'], private_key), challenge['nonce']
+
+def test_repeat_logins_look_the_user_up_once(context, db, query_counts, key_pair):
+    private_key, public_key = key_pair
+    alice = make_user(db, 'alice', public_key)
+    
+    assert authenticate_user('alice', *prove('alice', private_key))['_id'] == alice['_id']
+    first_login = query_counts['users']
+    
+    for _ in range(5):
+        user = authenticate_user('alice', *prove('alice', private_key))
+        assert user['_id'] == alice['_id']
+    
+    assert first_login > 0
+    assert query_counts['users'] == first_login
+
+def test_failed_proof_is_still_rejected_from_cache(context, db, key_pair):
+    private_key, public_key = key_pair
+    make_user(db, 'alice', public_key)
+    authenticate_user('alice', *prove('alice', private_key))
+    
+    _, nonce = prove('alice', private_key)
+    
+    assert authenticate_user('alice', sign_message('something else', private_key), nonce) is None
+
+def test_creating_a_user_drops_a_cached_unknown_username(app, context, key_pair):
+    private_key, public_key = key_pair
+    
+    assert authenticate_user('carol', *prove('carol', private_key)) is None
+    
+    response = app.test_client().post('/api/users', json={'username': 'carol', 'publicKey': public_key})
+    assert response.status_code in (200, 201)
+    
+    assert authenticate_user('carol', *prove('carol', private_key))['username'] == 'carol'
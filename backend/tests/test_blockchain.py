@@ -0,0 +1,89 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import blockchain
+from blockchain import MockWeb3, get_web3, is_connected
+
+class JSONRPCHandler(BaseHTTPRequestHandler):
+    """Answers every JSON-RPC call like a node, recording methods and connections"""
+    protocol_version = 'HTTP/1.1'
+    
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.calls.append(request['method'])
+        self.server.connections.add(self.client_address)
+        
+        result = {'web3_clientVersion': 'stand-in/1.0', 'eth_chainId': '0x539'}.get(request['method'])
+        body = json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def node(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), JSONRPCHandler)
+    server.calls = []
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    
+    monkeypatch.setattr(blockchain, '_web3_instances', {})
+    monkeypatch.setattr(blockchain, '_connection_state', {})
+    yield server, f'http://127.0.0.1:{server.server_address[1]}'
+    
+    server.shutdown()
+    server.server_close()
+
+def test_one_instance_per_uri(node):
+    _, uri = node
+    
+    assert get_web3(uri) is get_web3(uri)
+    assert get_web3(uri) is not get_web3(uri + '/other')
+
+def test_connectivity_is_probed_once_per_ttl(node, monkeypatch):
+    server, uri = node
+    
+    for _ in range(50):
+        assert is_connected(get_web3(uri))
+    assert server.calls.count('web3_clientVersion') == 1
+    
+    monkeypatch.setenv('WEB3_CONNECTED_TTL', '0')
+    assert is_connected(get_web3(uri))
+    assert server.calls.count('web3_clientVersion') == 2
+
+def test_calls_reuse_one_connection(node):
+    server, uri = node
+    w3 = get_web3(uri)
+    
+    chain_ids = {w3.eth.chain_id for _ in range(20)}
+    
+    assert chain_ids == {1337}
+    assert server.calls.count('eth_chainId') >= 1
+    assert len(server.connections) == 1
+
+def test_unreachable_node_is_cached_as_disconnected(monkeypatch):
+    monkeypatch.setattr(blockchain, '_web3_instances', {})
+    monkeypatch.setattr(blockchain, '_connection_state', {})
+    monkeypatch.setenv('WEB3_TIMEOUT', '1')
+    
+    with ThreadingHTTPServer(('127.0.0.1', 0), JSONRPCHandler) as server:
+        uri = f'http://127.0.0.1:{server.server_address[1]}'
+    
+    assert not is_connected(get_web3(uri))
+    assert blockchain._connection_state[uri][0] is False
+
+def test_mock_provider(monkeypatch):
+    monkeypatch.setenv('WEB3_PROVIDER_URI', 'mock')
+    
+    w3 = get_web3()
+    
+    assert isinstance(w3, MockWeb3)
+    assert is_connected(w3)
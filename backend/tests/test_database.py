@@ -0,0 +1,86 @@
+from datetime import datetime
+import pytest
+import database
+from memory_db import MemoryDB
+from inbox import get_message_history
+from tests.helpers import make_contacts, make_user
+
+@pytest.mark.parametrize('query, index', [
+    ('messages_history', 'conversation_id_1_timestamp_-1__id_-1'),
+    ('messages_page', 'conversation_id_1_timestamp_-1__id_-1'),
+    ('contacts_for_user', 'user_id_1_contact_id_1'),
+    ('contact_pair', 'user_id_1_contact_id_1'),
+    ('user_by_username', 'username_1'),
+])
+def test_hot_queries_use_an_index(db, query, index):
+    plans = database.explain_queries(db, 'user-a', 'user-b')
+    
+    assert plans[query]['stage'] == 'FETCH'
+    assert plans[query]['inputStage'] == {'stage': 'IXSCAN', 'indexName': index}
+
+def test_create_indexes_leaves_no_drift(db):
+    assert database.check_indexes(db) == []
+
+def test_check_indexes_reports_drift():
+    db = MemoryDB()
+    database.create_indexes(db)
+    db.messages.drop_index('timestamp_1')
+    db.users.create_index([('created_at', 1)], name='created_at_1')
+    
+    assert sorted(database.check_indexes(db), key=lambda entry: entry['index']) == [
+        {'collection': 'users', 'index': 'created_at_1', 'problem': 'extra'},
+        {'collection': 'messages', 'index': 'timestamp_1', 'problem': 'missing'},
+    ]
+
+def test_create_indexes_drops_retired_indexes():
+    db = MemoryDB()
+    db.messages.create_index([('receiver_id', 1), ('is_read', 1), ('sender_id', 1)],
+                             name='receiver_id_1_is_read_1_sender_id_1')
+    database.create_indexes(db)
+    
+    assert 'receiver_id_1_is_read_1_sender_id_1' not in db.messages.index_information()
+
+def test_backfill_makes_legacy_messages_visible(db, monkeypatch):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_contacts(db, alice, bob)
+    db.messages.insert_one({'_id': 'legacy', 'sender_id': alice['_id'], 'receiver_id': bob['_id'],
+                            'content': 'old', 'timestamp': datetime(2020, 1, 1), 'is_read': False})
+    assert get_message_history(db, bob['_id'], alice['_id'])[0] == []
+    
+    # MemoryDB has no bulk_write; apply the UpdateOne operations directly
+    monkeypatch.setattr(type(db.messages), 'bulk_write', _bulk_write, raising=False)
+    assert database.backfill_conversation_ids(db) == 1
+    
+    messages, _ = get_message_history(db, bob['_id'], alice['_id'])
+    assert [message['_id'] for message in messages] == ['legacy']
+
+def test_run_migration_runs_once(db):
+    calls = []
+    
+    def migrate(db):
+        calls.append(1)
+        return 7
+    
+    assert database.run_migration(db, 'example', migrate) == 7
+    assert database.run_migration(db, 'example', migrate) is None
+    assert len(calls) == 1
+    assert db.migrations.find_one({'_id': 'example'})['state'] == 'done'
+
+def test_failed_migration_can_be_retried(db):
+    def broken(db):
+        raise RuntimeError('boom')
+    
+    with pytest.raises(RuntimeError):
+        database.run_migration(db, 'example', broken)
+    
+    assert database.run_migration(db, 'example', lambda db: 'ok') == 'ok'
+
+class _BulkResult:
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+def _bulk_write(collection, operations, ordered=True):
+    modified = 0
+    for operation in operations:
+        modified += collection.update_one(operation._filter, operation._doc).modified_count
+    return _BulkResult(modified)
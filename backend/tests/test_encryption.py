@@ -0,0 +1,20 @@
+import pytest
+
+from encryption import generate_key_pair, sign_message, verify_signatures
+
+@pytest.fixture(scope='module')
+def key_pair():
+    return generate_key_pair()
+
+@pytest.mark.parametrize('workers', [None, 1, 4])
+def test_verify_signatures_with_no_items(workers):
+    assert list(verify_signatures([], workers=workers)) == []
+
+def test_verify_signatures_single_batch(key_pair):
+    private_key, public_key = key_pair
+    items = [
+        ('good', 'hello', sign_message('hello', private_key), public_key),
+        ('bad', 'hello', sign_message('other', private_key), public_key)
+    ]
+    
+    assert dict(verify_signatures(items, workers=4)) == {'good': True, 'bad': False}
@@ -0,0 +1,140 @@
+from datetime import datetime
+import pytest
+from inbox import (MAX_PAGE_SIZE, get_contact_list, get_message_history, mark_read,
+                   page_size, rebuild_conversations)
+from models import conversation_key
+from tests.helpers import make_contacts, make_messages, make_user
+
+def _user_with_contacts(db, count):
+    user = make_user(db, 'owner')
+    for i in range(count):
+        contact = make_user(db, f'contact{i}')
+        make_contacts(db, user, contact)
+        make_messages(db, contact, user, 2)
+    return user
+
+@pytest.mark.parametrize('contacts', [1, 5, 40])
+def test_contact_list_query_count_is_constant(db, query_counts, contacts):
+    user = _user_with_contacts(db, contacts)
+    query_counts.clear()
+    
+    rows, _ = get_contact_list(db, user['_id'])
+    
+    assert len(rows) == contacts
+    assert sum(query_counts.values()) == 3
+    assert query_counts == {'contacts': 1, 'users': 1, 'conversations': 1}
+
+def test_contact_list_summaries(db):
+    user = _user_with_contacts(db, 2)
+    
+    rows, _ = get_contact_list(db, user['_id'])
+    
+    assert [row['unread_count'] for row in rows] == [2, 2]
+    assert all(row['last_message']['content'] == 'm1' for row in rows)
+
+def test_contact_list_pages_cover_every_contact_once(db):
+    user = _user_with_contacts(db, 7)
+    
+    seen, cursor = [], None
+    while True:
+        rows, cursor = get_contact_list(db, user['_id'], limit=3, after=cursor)
+        seen.extend(row['user']['username'] for row in rows)
+        if cursor is None:
+            break
+    
+    assert sorted(seen) == sorted(f'contact{i}' for i in range(7))
+    assert len(seen) == len(set(seen))
+
+def test_message_pages_run_back_from_the_newest(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_contacts(db, alice, bob)
+    make_messages(db, alice, bob, 10)
+    
+    pages, cursor = [], None
+    while True:
+        messages, cursor = get_message_history(db, bob['_id'], alice['_id'], limit=4, before=cursor)
+        pages.append([message['content'] for message in messages])
+        if cursor is None:
+            break
+    
+    assert pages == [['m6', 'm7', 'm8', 'm9'], ['m2', 'm3', 'm4', 'm5'], ['m0', 'm1']]
+
+def test_message_pages_catch_up_after_a_cursor(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_contacts(db, alice, bob)
+    make_messages(db, alice, bob, 6)
+    
+    first, cursor = get_message_history(db, bob['_id'], alice['_id'], limit=2, before=None)
+    older, _ = get_message_history(db, bob['_id'], alice['_id'], limit=10, after=None, before=cursor)
+    newer, _ = get_message_history(db, bob['_id'], alice['_id'], limit=10, after=cursor)
+    
+    assert [message['content'] for message in first] == ['m4', 'm5']
+    assert [message['content'] for message in older] == ['m0', 'm1', 'm2', 'm3']
+    assert [message['content'] for message in newer] == ['m5']
+
+def test_malformed_cursor_is_rejected(db):
+    with pytest.raises(ValueError):
+        get_message_history(db, 'a', 'b', limit=5, before='not-a-cursor')
+
+@pytest.mark.parametrize('limit, expected', [(None, None), (1, 1), (50, 50), (10000, MAX_PAGE_SIZE)])
+def test_page_size(limit, expected):
+    assert page_size(limit) == expected
+
+@pytest.mark.parametrize('limit', [0, -1, -5])
+def test_page_size_rejects_values_below_one(limit):
+    with pytest.raises(ValueError):
+        page_size(limit)
+
+def test_mark_read_updates_summary_and_pending_queue(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_contacts(db, alice, bob)
+    messages = make_messages(db, alice, bob, 3)
+    db.pending_deliveries.insert_many([
+        {'_id': message['_id'], 'user_id': bob['_id'], 'timestamp': message['timestamp']}
+        for message in messages
+    ])
+    
+    receipts = mark_read(db, bob['_id'], message_ids=[messages[0]['_id']])
+    assert receipts[alice['_id']]['count'] == 1
+    assert db.pending_deliveries.count_documents({'user_id': bob['_id']}) == 2
+    
+    mark_read(db, bob['_id'], contact_id=alice['_id'])
+    rows, _ = get_contact_list(db, bob['_id'])
+    assert rows[0]['unread_count'] == 0
+    assert db.pending_deliveries.count_documents({'user_id': bob['_id']}) == 0
+
+def test_rebuild_matches_incremental_summaries(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_contacts(db, alice, bob)
+    make_messages(db, alice, bob, 4)
+    mark_read(db, bob['_id'], contact_id=alice['_id'])
+    make_messages(db, bob, alice, 2, start=datetime(2024, 1, 2))
+    before = get_contact_list(db, alice['_id'])[0]
+    
+    db.conversations.delete_many({})
+    rebuild_conversations(db)
+    
+    assert get_contact_list(db, alice['_id'])[0] == before
+
+def test_rebuild_missing_only_keeps_live_summaries(db):
+    alice, bob, carol = make_user(db, 'alice'), make_user(db, 'bob'), make_user(db, 'carol')
+    make_contacts(db, alice, bob)
+    make_contacts(db, alice, carol)
+    make_messages(db, bob, alice, 3)
+    make_messages(db, carol, alice, 2)
+    
+    # carol's summary is missing; bob's has a counter a live worker bumped
+    # after the rebuild read the messages
+    db.conversations.delete_one({'_id': conversation_key(alice['_id'], carol['_id'])})
+    live_key = conversation_key(alice['_id'], bob['_id'])
+    db.conversations.update_one({'_id': live_key}, {'$inc': {f"unread.{alice['_id']}": 1}})
+    
+    assert rebuild_conversations(db, missing_only=True) == 1
+    
+    assert db.conversations.find_one({'_id': live_key})['unread'][alice['_id']] == 4
+    rebuilt = db.conversations.find_one({'_id': conversation_key(alice['_id'], carol['_id'])})
+    assert rebuilt['unread'][alice['_id']] == 2
+
+def test_message_history_rejects_both_cursors(db):
+    with pytest.raises(ValueError):
+        get_message_history(db, 'a', 'b', limit=5, before='x', after='y')
@@ -0,0 +1,111 @@
+import threading
+import pytest
+from pymongo.errors import DuplicateKeyError
+import ingest
+from ingest import MessageIngestor
+from memory_db import MemoryCollection
+from models import Message
+from tests.helpers import make_contacts, make_user
+
+@pytest.fixture
+def users(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_contacts(db, alice, bob)
+    return alice, bob
+
+def _message(sender, receiver, content='hi'):
+    return Message(sender_id=sender['_id'], receiver_id=receiver['_id'], content=content).to_dict()
+
+def test_ingest_stores_and_notifies(db, users):
+    alice, bob = users
+    ingestor = MessageIngestor(window=0)
+    delivered = []
+    ingestor.add_listener(delivered.extend)
+    
+    message = ingestor.ingest(_message(alice, bob))
+    
+    assert db.messages.find_one({'_id': message['_id']}) is not None
+    assert db.pending_deliveries.find_one({'_id': message['_id']})['user_id'] == bob['_id']
+    assert db.conversations.find_one({})['unread'][bob['_id']] == 1
+    assert delivered == [message]
+
+def test_concurrent_senders_share_batches(db, users):
+    alice, bob = users
+    ingestor = MessageIngestor(window=0.005)
+    ingestor.last_batch_size = 2
+    results = []
+    
+    def send(i):
+        results.append(ingestor.ingest(_message(alice, bob, f'm{i}')))
+    
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len(results) == 30
+    assert db.messages.count_documents({}) == 30
+    assert db.conversations.find_one({})['unread'][bob['_id']] == 30
+    assert ingestor.stats()['batches'] < 30
+
+def test_duplicate_message_fails_only_its_caller(db, users):
+    alice, bob = users
+    ingestor = MessageIngestor(window=0)
+    message = ingestor.ingest(_message(alice, bob))
+    
+    with pytest.raises(DuplicateKeyError):
+        ingestor.ingest(dict(message))
+    assert ingestor.stats()['failures'] == 1
+
+def test_follow_up_failure_still_reports_success(db, users, monkeypatch):
+    alice, bob = users
+    ingestor = MessageIngestor(window=0)
+    delivered = []
+    ingestor.add_listener(delivered.extend)
+    
+    def broken(db, messages):
+        raise RuntimeError('summary write failed')
+    
+    monkeypatch.setattr(ingest, 'record_messages', broken)
+    message = ingestor.ingest(_message(alice, bob))
+    
+    assert db.messages.find_one({'_id': message['_id']}) is not None
+    assert db.pending_deliveries.find_one({'_id': message['_id']}) is not None
+    assert delivered == [message]
+    assert ingestor.stats()['followUpErrors'] == 1
+
+def test_unexpected_write_error_fails_every_caller_in_the_batch(db, users, monkeypatch):
+    alice, bob = users
+    ingestor = MessageIngestor(window=0)
+    delivered = []
+    ingestor.add_listener(delivered.extend)
+    
+    def unencodable(self, documents, ordered=True):
+        raise OverflowError('MongoDB can only handle up to 8-byte ints')
+    
+    monkeypatch.setattr(MemoryCollection, 'insert_many', unencodable)
+    
+    # Other senders already waiting join the same batch
+    waiting = [ingest._Entry(_message(alice, bob, f'm{i}')) for i in range(3)]
+    ingestor.queue.extend(waiting)
+    
+    with pytest.raises(OverflowError):
+        ingestor.ingest(_message(alice, bob))
+    
+    assert all(entry.done and isinstance(entry.error, OverflowError) for entry in waiting)
+    assert delivered == []
+    assert ingestor.stats()['failures'] == 4
+
+def test_error_before_the_write_fails_the_batch(db, users, monkeypatch):
+    alice, bob = users
+    ingestor = MessageIngestor(window=0)
+    
+    def unavailable():
+        raise RuntimeError('no database')
+    
+    monkeypatch.setattr(ingest, 'get_database', unavailable)
+    
+    with pytest.raises(RuntimeError):
+        ingestor.ingest(_message(alice, bob))
+    assert ingestor.queue == []
@@ -0,0 +1,75 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import keypool
+from keypool import KeyPool, get_key_pool, close_key_pools
+
+def threaded_pool(**kwargs):
+    # Patched generators are not visible to worker processes, so run in threads
+    pool = KeyPool(**kwargs)
+    pool.executor = ThreadPoolExecutor(max_workers=pool.workers)
+    return pool
+
+@pytest.mark.parametrize('key_size', [0, 512, 1023])
+def test_small_key_sizes_are_rejected_before_a_pool_exists(key_size):
+    with pytest.raises(ValueError):
+        get_key_pool(key_size)
+    
+    assert key_size not in keypool._pools
+    with pytest.raises(ValueError):
+        KeyPool(key_size=key_size)
+
+def test_failed_generation_backs_off(monkeypatch):
+    calls = []
+    
+    def failing(key_size):
+        calls.append(key_size)
+        raise RuntimeError('no entropy')
+    
+    monkeypatch.setattr(keypool, 'generate_pem_pair', failing)
+    pool = threaded_pool(target_depth=4, workers=2, backoff=10)
+    try:
+        pool.start()
+        time.sleep(0.3)
+        
+        # One round of the target depth, then nothing until the backoff ends
+        assert len(calls) <= 4
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            pool.get(timeout=5)
+        assert time.monotonic() - started < 1
+        assert pool.stats()['failures'] >= 1
+        assert 'no entropy' in pool.stats()['lastError']
+    finally:
+        pool.close()
+
+def test_pool_recovers_after_the_backoff(monkeypatch):
+    attempts = []
+    
+    def flaky(key_size):
+        attempts.append(key_size)
+        if len(attempts) == 1:
+            raise RuntimeError('transient')
+        return 'private', 'public'
+    
+    monkeypatch.setattr(keypool, 'generate_pem_pair', flaky)
+    pool = threaded_pool(target_depth=1, workers=1, backoff=0.05)
+    try:
+        pool.start()
+        time.sleep(0.2)
+        
+        assert pool.get(timeout=1) == ('private', 'public')
+        assert pool.stats()['failures'] == 0
+    finally:
+        pool.close()
+
+def test_close_key_pools_stops_every_pool(monkeypatch):
+    closed = []
+    monkeypatch.setattr(keypool, '_pools', {2048: type('Pool', (), {'close': lambda self: closed.append(1)})()})
+    
+    close_key_pools()
+    
+    assert closed == [1]
+    assert keypool._pools == {}
@@ -0,0 +1,136 @@
+import threading
+import time
+from outbox import EmitBatcher
+
+class FakeSocketIO:
+    """
+    Records emits; background tasks are real threads
+    """
+    def __init__(self):
+        self.emitted = []
+        self.tasks = 0
+    
+    def emit(self, event, data, room=None):
+        self.emitted.append((event, room, data))
+    
+    def start_background_task(self, target):
+        self.tasks += 1
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+    
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+def _wait_idle(outbox, timeout=1):
+    deadline = time.monotonic() + timeout
+    while outbox.flusher is not None and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+def test_single_event_keeps_the_old_shape():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=0.005)
+    
+    outbox.queue('user:1', {'id': 'a'})
+    _wait_idle(outbox)
+    
+    assert socketio.emitted == [('new_message', 'user:1', {'id': 'a'})]
+
+def test_events_are_batched_per_room_in_order():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=0.05, max_batch=100)
+    
+    for i in range(5):
+        outbox.queue('user:1', {'id': i})
+    outbox.queue('user:2', {'id': 'x'})
+    _wait_idle(outbox)
+    
+    assert sorted(socketio.emitted, key=lambda emit: emit[1]) == [
+        ('new_messages', 'user:1', {'messages': [{'id': i} for i in range(5)]}),
+        ('new_message', 'user:2', {'id': 'x'}),
+    ]
+
+def test_full_batch_is_sent_straight_away():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=10, max_batch=3)
+    
+    for i in range(3):
+        outbox.queue('user:1', {'id': i})
+    
+    assert socketio.emitted == [('new_messages', 'user:1', {'messages': [{'id': 0}, {'id': 1}, {'id': 2}]})]
+
+def test_flusher_stops_when_idle_and_restarts_on_demand():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=0.005)
+    
+    outbox.queue('user:1', {'id': 1})
+    _wait_idle(outbox)
+    assert outbox.flusher is None
+    
+    outbox.queue('user:1', {'id': 2})
+    _wait_idle(outbox)
+    assert socketio.tasks == 2
+    assert len(socketio.emitted) == 2
+
+def test_room_behind_on_acks_gets_sync_required():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=0.005, max_unacked=3)
+    
+    accepted = [outbox.queue('user:1', {'id': i}) for i in range(5)]
+    _wait_idle(outbox)
+    
+    assert accepted == [True, True, True, False, False]
+    assert [event for event, _, _ in socketio.emitted] == ['new_messages', 'sync_required']
+    assert outbox.stats()['laggingRooms'] == 1
+    
+    # Acks alone do not resume a lagging room; catching up does
+    outbox.acknowledged('user:1', 3)
+    assert outbox.queue('user:1', {'id': 5}) is False
+    outbox.reset('user:1')
+    assert outbox.queue('user:1', {'id': 6}) is True
+
+def test_acks_make_room_for_more_events():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=0.005, max_unacked=2)
+    
+    for i in range(2):
+        outbox.queue('user:1', {'id': i})
+    _wait_idle(outbox)
+    outbox.acknowledged('user:1', 2)
+    
+    assert outbox.queue('user:1', {'id': 2}) is True
+
+def test_rooms_on_other_workers_get_no_backpressure():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=0.005, max_unacked=2)
+    
+    accepted = [outbox.queue('user:1', {'id': i}, track=False) for i in range(5)]
+    _wait_idle(outbox)
+    
+    # No ack will ever reach this worker, so nothing is counted against the room
+    assert accepted == [True] * 5
+    assert [event for event, _, _ in socketio.emitted] == ['new_messages']
+    assert outbox.stats()['unacked'] == 0
+    assert outbox.stats()['laggingRooms'] == 0
+
+def test_only_tracked_events_count_as_unacked():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio, window=0.005, max_unacked=3)
+    
+    outbox.queue('user:1', {'id': 0}, track=False)
+    outbox.queue('user:1', {'id': 1})
+    outbox.queue('user:1', {'id': 2}, track=False)
+    outbox.queue('user:1', {'id': 3})
+    _wait_idle(outbox)
+    
+    assert outbox.stats()['unacked'] == 2
+    assert outbox.queue('user:1', {'id': 4}) is True
+
+def test_emit_rate_is_not_capped():
+    socketio = FakeSocketIO()
+    outbox = EmitBatcher(socketio)
+    
+    for _ in range(20000):
+        outbox._count(1)
+    
+    assert outbox.stats()['emitsPerSec'] == 2000
@@ -0,0 +1,26 @@
+import pytest
+
+from presence import PresenceRegistry, create_presence
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    monkeypatch.delenv('PRESENCE_URL', raising=False)
+    monkeypatch.delenv('REDIS_URL', raising=False)
+
+def test_single_worker_uses_a_local_registry():
+    assert isinstance(create_presence(None), PresenceRegistry)
+
+@pytest.mark.parametrize('message_queue', ['amqp://broker//', 'kafka://broker:9092'])
+def test_message_queue_without_shared_presence_fails(message_queue):
+    with pytest.raises(ValueError):
+        create_presence(message_queue)
+
+def test_is_local_only_sees_this_workers_sockets():
+    presence = PresenceRegistry()
+    presence.connect('alice', 'sid-1')
+    
+    assert presence.is_local('alice')
+    assert not presence.is_local('bob')
+    
+    presence.disconnect('sid-1')
+    assert not presence.is_local('alice')
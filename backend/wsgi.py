@@ -0,0 +1,29 @@
+# Production entry point. Monkey-patching has to happen before anything
+# imports socket, ssl, threading or pymongo, so this module patches first and
+# only then imports the app. pymongo supports gevent once patched: each
+# greenlet borrows a pooled connection (size it with MONGO_MAX_POOL_SIZE and
+# MONGO_WAIT_QUEUE_TIMEOUT_MS) and waits cooperatively on the socket. RSA work
+# is sent to native threads with encryption.offload.
+#
+#   gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 \
+#            --bind 0.0.0.0:5000 wsgi:app
+#
+# Run one worker per process. To use more cores or hosts, run several behind
+# a load balancer with sticky sessions and set SOCKETIO_MESSAGE_QUEUE and
+# REDIS_URL so emits and presence are shared between them.
+import os
+
+ASYNC_MODE = os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'gevent')
+
+# encryption.offload only knows how to leave a gevent loop, so eventlet is
+# not offered here
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE != 'threading':
+    raise RuntimeError(f"Unsupported SOCKETIO_ASYNC_MODE {ASYNC_MODE!r}, use gevent or threading")
+
+from app import app, socketio
+
+if __name__ == '__main__':
+    socketio.run(app, host='0.0.0.0', port=int(os.getenv('PORT', 5000)))